@@ -1,17 +1,24 @@
-from bot import bot
+from bot import run_polling, start_webhook, webhook_secret
+from webhook import SECRET_HEADER
+from config import WEBHOOK_URL
 from flask import Flask, request
+import hmac
 import threading
 import os
 
 # Flask app for Railway web service
 app = Flask(__name__)
 
-# Run bot in background thread
-def run_bot():
-    bot.infinity_polling()
+# Webhook mode when WEBHOOK_URL is set; otherwise poll in a background thread
+webhook_ingest = None
+if WEBHOOK_URL:
+    webhook_ingest = start_webhook()
+else:
+    def run_bot():
+        run_polling()
 
-thread = threading.Thread(target=run_bot, daemon=True)
-thread.start()
+    thread = threading.Thread(target=run_bot, daemon=True)
+    thread.start()
 
 # Health check endpoint (required for Railway)
 @app.route('/')
@@ -22,11 +29,16 @@ def home():
 def health():
     return "OK", 200
 
-# Optional: Webhook endpoint if you want to use webhooks instead of polling
+# Telegram update delivery (webhook mode): queue the raw body and answer at once
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    update = request.get_json()
-    bot.process_new_updates([telebot.types.Update.de_json(update)])
+    if webhook_ingest is None:
+        return "Webhook mode is off", 404
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), webhook_secret):
+        return "Forbidden", 403
+    if not webhook_ingest.put(request.get_data()):
+        # Telegram redelivers the update later
+        return "Busy", 503
     return "OK", 200
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+import heapq
+import threading
+import time
+
+# ============ BAN REGISTRY ============
+# Index over spam_data's ban state. Active bans sit in a min-heap keyed by
+# expiry plus a uid -> blocked_until map, so "is blocked" is O(1), counting
+# active bans is amortized O(log n) and listing them is O(k log k) instead
+# of scanning every spam_data entry. Expired bans are evicted lazily when
+# they reach the top of the heap.
+#
+# The active bans are also persisted in a small index store (uid ->
+# blocked_until), so boot reads that instead of all of spam_data, which
+# may be sharded and lazily loaded. Only the first boot without an index
+# scans spam_data to build it.
+
+# Marks an index that was built completely (and not just created empty)
+INDEX_COMPLETE = "_complete"
+
+
+class BanRegistry:
+    """Tracks active bans stored in a spam_data-style store"""
+
+    def __init__(self, store, new_entry, index=None):
+        self.store = store
+        self.new_entry = new_entry
+        self.index = index if index is not None else {}
+        self.lock = threading.Lock()
+        self.heap = []
+        self.active = {}
+        now = time.time()
+        if self.index.get(INDEX_COMPLETE):
+            bans = [(uid, until) for uid, until in self.index.items() if uid != INDEX_COMPLETE]
+        else:
+            bans = [(uid, entry.get("blocked_until", 0)) for uid, entry in store.items()]
+            self.index[INDEX_COMPLETE] = 1
+        for uid, until in bans:
+            if until > now:
+                self.active[uid] = until
+                self.heap.append((until, uid))
+                self.index[uid] = until
+            else:
+                self.index.pop(uid, None)
+        heapq.heapify(self.heap)
+
+    def _evict(self, now):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            until, uid = heapq.heappop(heap)
+            # Skip stale heap items left behind by a re-ban or an unban
+            if self.active.get(uid) == until:
+                del self.active[uid]
+                self.index.pop(uid, None)
+
+    def block(self, user_id, until, reason=None, banned_by=None, level=None):
+        """Ban until the given epoch time; None arguments keep the stored value"""
+        uid = str(user_id)
+        if uid not in self.store:
+            self.store[uid] = self.new_entry()
+        entry = self.store[uid]
+        entry["blocked_until"] = until
+        if reason is not None:
+            entry["ban_reason"] = reason
+        if banned_by is not None:
+            entry["banned_by"] = banned_by
+        if level is not None:
+            entry["block_level"] = level
+        self.store.touch(uid)
+        with self.lock:
+            self.active[uid] = until
+            self.index[uid] = until
+            heapq.heappush(self.heap, (until, uid))
+        return entry
+
+    def unblock(self, user_id):
+        """Lift a ban and forget the user's ban history; False if unknown"""
+        uid = str(user_id)
+        with self.lock:
+            self.active.pop(uid, None)
+            self.index.pop(uid, None)
+        return self.store.pop(uid, None) is not None
+
+    def blocked_until(self, user_id, now=None):
+        """Expiry of the user's active ban, or 0"""
+        until = self.active.get(str(user_id), 0)
+        if until and until <= (now or time.time()):
+            return 0
+        return until
+
+    def is_blocked(self, user_id, now=None):
+        return self.blocked_until(user_id, now) > 0
+
+    def count_active(self, now=None):
+        with self.lock:
+            self._evict(now or time.time())
+            return len(self.active)
+
+    def list_active(self, now=None):
+        """[(uid, blocked_until, entry)] for active bans, soonest expiry first"""
+        with self.lock:
+            self._evict(now or time.time())
+            active = sorted(self.active.items(), key=lambda item: item[1])
+        return [(uid, until, self.store.get(uid, {})) for uid, until in active]
@@ -1,6 +1,6 @@
+from startup import startup_timings, startup_total_ms  # starts the startup clock before the heavy imports
 import telebot
 from telebot import types
-import qrcode
 import time
 import threading
 from datetime import datetime, timedelta
@@ -10,17 +10,30 @@ import json
 import os
 import sys
 import requests
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Import config and verification
 from config import *
 from verif import init_verification
-
-# Debug token loading
-print("=" * 60)
-print("🔍 DEBUGGING TOKEN LOADING")
-print("=" * 60)
-print(f"BOT_TOKEN from env: {'✅ FOUND' if BOT_TOKEN else '❌ NOT FOUND'}")
-if BOT_TOKEN:
+from records import UserRecord
+from limiter import SpamLimiter
+from bans import BanRegistry
+from sweeper import run_sweep, sweep_broadcast_jobs
+from broadcast import BroadcastEngine, AsyncBroadcastEngine, Checkpoint, SENT as BROADCAST_SENT, FAILED as BROADCAST_FAILED, \
+    UNREACHABLE as BROADCAST_UNREACHABLE, SKIPPED as BROADCAST_SKIPPED
+from storage import to_plain
+from outbound import OutboundScheduler, BROADCAST, retry_after
+from dispatch import LaneDispatcher, AdmissionController, ADMIN, PAYMENT, GENERAL
+from qrcache import QRCache
+from webhook import WebhookIngest
+
+# Token check: runs in the background so startup never waits on the network
+def probe_token():
+    print(f"BOT_TOKEN from env: {'✅ FOUND' if BOT_TOKEN else '❌ NOT FOUND'}")
+    if not BOT_TOKEN:
+        return
     print(f"Token starts with: {BOT_TOKEN[:10]}...")
     try:
         test_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getMe"
@@ -32,13 +45,96 @@ if BOT_TOKEN:
             print(f"❌ Token INVALID!")
     except Exception as e:
         print(f"❌ Error testing token: {e}")
-print("=" * 60)
 
-# Initialize bot
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+threading.Thread(target=probe_token, name="token-probe", daemon=True).start()
+
+# Initialize bot; handlers run on the lane workers below, not telebot's pool
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
+
+# Every send/edit goes through one rate-limited, prioritized scheduler
+outbound = OutboundScheduler(
+    rate=OUTBOUND_RATE,
+    chat_rate=OUTBOUND_CHAT_RATE,
+    group_rate=OUTBOUND_GROUP_RATE,
+    log_chats=lambda: (str(current_settings()['log_channel']),)
+)
+outbound.install(bot)
+
+# Priority lanes: admin and payment updates never wait behind /start floods
+ADMIN_CALLBACKS = ("verify_", "reject_")
+PAYMENT_CALLBACKS = ("plan_", "get_premium", "payment_done")
+
+def update_lane(update):
+    if update.callback_query:
+        call = update.callback_query
+        data = call.data or ""
+        if str(call.from_user.id) == ADMIN_ID or data.startswith(ADMIN_CALLBACKS):
+            return ADMIN
+        if data.startswith(PAYMENT_CALLBACKS):
+            return PAYMENT
+        return GENERAL
+    message = update.message or update.edited_message
+    if message and message.from_user:
+        if str(message.from_user.id) == ADMIN_ID:
+            return ADMIN
+        if message.photo and str(message.from_user.id) in pending_verifications:
+            # Payment screenshot
+            return PAYMENT
+    return GENERAL
+
+def update_user(update):
+    """Whose data the update's handlers touch (verify/reject: the paying user)"""
+    if update.callback_query:
+        call = update.callback_query
+        data = call.data or ""
+        if data.startswith(ADMIN_CALLBACKS):
+            return data.split('_', 1)[1]
+        return call.from_user.id
+    message = update.message or update.edited_message
+    if message and message.from_user:
+        return message.from_user.id
+    return None
+
+# Answers are not chat messages (no chat rate limit), so shed callbacks are
+# answered directly, off the polling thread, before the ~15 s query expiry
+shed_acks = ThreadPoolExecutor(max_workers=4, thread_name_prefix="shed-ack")
+
+def shed_update(update, reason):
+    """Cheap acknowledgement for a shed update: stop the button spinner"""
+    if update.callback_query:
+        shed_acks.submit(bot.answer_callback_query, update.callback_query.id)
+
+admission = AdmissionController(
+    max_depth=SHED_QUEUE_DEPTH,
+    max_wait_ms=SHED_WAIT_MS,
+    dedupe_window=SHED_DEDUPE_WINDOW,
+    on_shed=shed_update
+)
+dispatcher = LaneDispatcher(
+    bot, update_lane, LANE_WORKERS, admission,
+    user_of=update_user
+)
+dispatcher.install()
+
+# ENGINE=async: asyncio polling and broadcasts over one shared aiohttp session
+# (engine_async.py); handlers still run on the lane threads.
+# Webhook mode has no polling loop, so it always uses the thread engine.
+async_engine = None
+if ENGINE == "async" and WEBHOOK_URL:
+    logging.warning("ENGINE=async is ignored in webhook mode")
+elif ENGINE == "async":
+    from engine_async import AsyncEngine
+    async_engine = AsyncEngine(
+        BOT_TOKEN, dispatcher,
+        connections=ASYNC_CONNECTIONS,
+        autosave=lambda: autosave_once(),
+        autosave_interval=AUTOSAVE_INTERVAL,
+        on_ready=lambda: resume_broadcast_jobs()
+    )
 
 # Initialize verification system
 verif = init_verification(bot)
+startup_stage("bot_setup")
 
 # Setup logging
 logging.basicConfig(
@@ -46,56 +142,42 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Auto-save thread
+# Auto-save: flushes only what changed since the last run
+def autosave_once():
+    if flush_dirty_data():
+        logging.debug(f"💾 Flushed {persist_metrics['last_keys']} entries "
+                      f"({persist_metrics['last_bytes']} bytes) in {persist_metrics['last_duration_ms']:.1f} ms")
+
 def auto_save_data():
     while True:
-        time.sleep(30)
-        save_all_data()
+        time.sleep(AUTOSAVE_INTERVAL)
+        try:
+            autosave_once()
+        except Exception as e:
+            logging.error(f"Auto-save error: {e}")
 
 auto_save_thread = threading.Thread(target=auto_save_data, daemon=True)
-auto_save_thread.start()
+if async_engine is None:
+    # The async engine runs autosave as a task on its loop
+    auto_save_thread.start()
 
 # ============ SPAM PROTECTION FUNCTIONS ============
-def update_user_activity(user_id):
-    user_id_str = str(user_id)
-    current_time = time.time()
-    
-    if user_id_str not in spam_data:
-        spam_data[user_id_str] = {
-            "requests": [],
-            "warnings": 0,
-            "blocked_until": 0,
-            "block_level": 0,
-            "ban_reason": "",
-            "banned_by": 0
-        }
-    
-    if "requests" not in spam_data[user_id_str]:
-        spam_data[user_id_str]["requests"] = []
-    
-    spam_data[user_id_str]["requests"] = [
-        ts for ts in spam_data[user_id_str]["requests"] 
-        if current_time - ts < SPAM_TIME_WINDOW
-    ]
-    
-    spam_data[user_id_str]["requests"].append(current_time)
-    return len(spam_data[user_id_str]["requests"])
+# Request counting and warnings are in-memory only; spam_data keeps bans
+spam_limiter = SpamLimiter(MAX_SPAM_COUNT, SPAM_TIME_WINDOW)
+ban_registry = BanRegistry(spam_data, new_spam_entry, ban_index)
+
+def update_user_activity(user_id, current_time=None):
+    return spam_limiter.hit(str(user_id), current_time)
 
 def check_user_blocked(user_id):
     user_id_str = str(user_id)
     
-    if user_id_str not in spam_data:
-        return False, None
-    
-    user_data = spam_data[user_id_str]
-    
-    if "blocked_until" not in user_data:
-        user_data["blocked_until"] = 0
-    
     current_time = time.time()
+    blocked_until = ban_registry.blocked_until(user_id_str, current_time)
     
-    if user_data["blocked_until"] > current_time:
-        time_left = int(user_data["blocked_until"] - current_time)
+    if blocked_until:
+        user_data = spam_data.get(user_id_str, {})
+        time_left = int(blocked_until - current_time)
         minutes = time_left // 60
         seconds = time_left % 60
         hours = minutes // 60
@@ -123,22 +205,14 @@ def check_spam(user_id):
         return block_msg
     
     current_time = time.time()
-    request_count = update_user_activity(user_id)
-    
-    if "warnings" not in spam_data[user_id_str]:
-        spam_data[user_id_str]["warnings"] = 0
-    if "block_level" not in spam_data[user_id_str]:
-        spam_data[user_id_str]["block_level"] = 0
-    if "blocked_until" not in spam_data[user_id_str]:
-        spam_data[user_id_str]["blocked_until"] = 0
+    request_count = update_user_activity(user_id_str, current_time)
     
     if request_count >= MAX_SPAM_COUNT:
-        user_data = spam_data[user_id_str]
-        user_data["block_level"] = min(2, user_data.get("block_level", 0) + 1)
-        block_duration = BLOCK_DURATIONS[user_data["block_level"]]
-        user_data["blocked_until"] = current_time + block_duration
-        user_data["requests"] = []
-        user_data["warnings"] = 0
+        block_level = min(2, spam_data.get(user_id_str, {}).get("block_level", 0) + 1)
+        block_duration = BLOCK_DURATIONS[block_level]
+        user_data = ban_registry.block(user_id_str, current_time + block_duration, level=block_level)
+        spam_limiter.reset(user_id_str)
+        save_spam_data(user_id_str)
         
         # Notify admin
         try:
@@ -150,7 +224,7 @@ def check_spam(user_id):
 ⏰ Duration: {block_duration//60} minutes
 🔢 Spam Count: {request_count}
             """
-            bot.send_message(ADMIN_ID, admin_msg, parse_mode="HTML")
+            outbound.post(bot.send_message, ADMIN_ID, admin_msg, parse_mode="HTML")
         except:
             pass
         
@@ -161,11 +235,10 @@ def check_spam(user_id):
     
     if request_count >= 3:
         warning_level = min(2, request_count - 3)
-        if spam_data[user_id_str].get("warnings", 0) < warning_level + 1:
-            spam_data[user_id_str]["warnings"] = warning_level + 1
+        if spam_limiter.raise_warning(user_id_str, warning_level + 1):
             warning_msg = f"{WARNING_MESSAGES[warning_level]}\n\n⚠️ {MAX_SPAM_COUNT - request_count} attempts left!"
             try:
-                bot.send_message(user_id, warning_msg, parse_mode="HTML")
+                outbound.offer(bot.send_message, user_id, warning_msg, parse_mode="HTML")
             except:
                 pass
     
@@ -173,29 +246,16 @@ def check_spam(user_id):
 
 def reset_spam_counter(user_id):
     user_id_str = str(user_id)
-    if user_id_str in spam_data:
-        if spam_data[user_id_str].get("blocked_until", 0) < time.time():
-            spam_data[user_id_str]["requests"] = []
-            spam_data[user_id_str]["warnings"] = 0
+    if ban_registry.is_blocked(user_id_str):
+        return
+    spam_limiter.reset(user_id_str)
 
 def ban_user(user_id, duration_seconds, reason="", banned_by=ADMIN_ID):
     user_id_str = str(user_id)
     current_time = time.time()
     
-    if user_id_str not in spam_data:
-        spam_data[user_id_str] = {
-            "requests": [],
-            "warnings": 0,
-            "blocked_until": 0,
-            "block_level": 0,
-            "ban_reason": reason,
-            "banned_by": banned_by
-        }
-    
-    spam_data[user_id_str]["blocked_until"] = current_time + duration_seconds
-    spam_data[user_id_str]["ban_reason"] = reason
-    spam_data[user_id_str]["banned_by"] = banned_by
-    spam_data[user_id_str]["block_level"] = 3
+    ban_registry.block(user_id_str, current_time + duration_seconds, reason, banned_by, level=3)
+    save_spam_data(user_id_str)
     
     try:
         if duration_seconds >= 3600:
@@ -215,25 +275,113 @@ def ban_user(user_id, duration_seconds, reason="", banned_by=ADMIN_ID):
     
     return True
 
+# ============ STATE SWEEPER ============
+def sweep_state():
+    """Prune stale spam entries and old broadcast jobs, archive used/expired invite links"""
+    report = run_sweep(spam_data, invite_links, ban_registry, spam_limiter, INVITE_ARCHIVE_FILE, SPAM_RETENTION,
+                       lock_for=user_locks.lock_for)
+    job_keys, job_bytes = sweep_broadcast_jobs(broadcast_jobs, BROADCAST_JOB_RETENTION, time.time(),
+                                               broadcast_jobs_lock)
+    report["broadcast_jobs"] = len(job_keys)
+    report["bytes"] += job_bytes
+    if report["spam_keys"]:
+        save_spam_data(*report["spam_keys"])
+    if report["link_keys"]:
+        save_invite_links(*report["link_keys"])
+    if job_keys:
+        save_broadcast_jobs(*job_keys)
+    return report
+
+def sweeper_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep_state()
+        except Exception as e:
+            logging.error(f"Sweeper error: {e}")
+
+sweeper_thread = threading.Thread(target=sweeper_loop, daemon=True)
+sweeper_thread.start()
+
 # ============ PREMIUM BOT CLASS ============
+# Descriptions Telegram gives when a cached file_id can't be sent any more
+STALE_FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "wrong file_id",
+)
+
+def stale_file_id(error):
+    """True if the send failed because of the file_id, not the chat"""
+    description = str(getattr(error, "description", "") or error).lower()
+    return getattr(error, "error_code", None) == 400 and any(reason in description for reason in STALE_FILE_ID_ERRORS)
+
 class PremiumBot:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        self.qr_cache = QRCache(self.render_qr)
     
-    def generate_qr_code(self, upi_id, amount, name):
+    def render_qr(self, upi_id, amount, name):
+        """PNG bytes of the UPI payment QR"""
         try:
+            # qrcode and PIL load on first render (the boot warmup), not at import
+            import qrcode
             upi_url = f"upi://pay?pa={upi_id}&pn={name}&am={amount}&cu=INR"
-            qr = qrcode.QRCode(version=1, box_size=10, border=4)
+            qr = qrcode.QRCode(version=1, box_size=QR_BOX_SIZE, border=4)
             qr.add_data(upi_url)
             qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
+            # Black on white renders as a 1-bit image: a 2-entry palette PNG
+            img = qr.make_image(fill_color="black", back_color="white").get_image()
             img_bytes = BytesIO()
-            img.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
-            return img_bytes
+            img.save(img_bytes, format='PNG', optimize=True)
+            return img_bytes.getvalue()
         except Exception as e:
             self.logger.error(f"QR Error: {e}")
             return None
+    
+    def generate_qr_code(self, upi_id, amount, name):
+        """The QR as a cached file_id, or PNG bytes to upload (None on error)"""
+        return self.qr_cache.photo(upi_id, amount, name)
+    
+    def send_qr(self, chat_id, upi_id, amount, name, **kwargs):
+        """Send the payment QR, uploading it only the first time.
+        False if no QR could be rendered."""
+        photo = self.generate_qr_code(upi_id, amount, name)
+        if photo is None:
+            return False
+        try:
+            sent = bot.send_photo(chat_id, photo=photo, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if not isinstance(photo, str) or not stale_file_id(e):
+                raise
+            # Telegram no longer knows the file_id: upload the PNG again
+            self.qr_cache.forget_file_id(upi_id, amount, name)
+            sent = bot.send_photo(chat_id, photo=self.generate_qr_code(upi_id, amount, name), **kwargs)
+        self.qr_cache.remember(upi_id, amount, name, sent)
+        return True
+    
+    def warm_qr_codes(self):
+        """Render every plan's QR and upload it once to the log channel, so
+        payers are sent a file_id from the first click"""
+        snapshot = current_settings()
+        log_channel = snapshot.get('log_channel')
+        for plan in snapshot.plans.values():
+            def upload(photo, plan=plan):
+                return bot.send_photo(
+                    log_channel,
+                    photo=photo,
+                    caption=f"🔳 QR ready: {plan['name']} - ₹{plan['amount']}",
+                    disable_notification=True
+                )
+            try:
+                self.qr_cache.warm(snapshot['upi_id'], plan['amount'], snapshot['upi_name'],
+                                   upload if log_channel else None)
+            except Exception as e:
+                self.logger.error(f"QR warmup error ({plan['name']}): {e}")
+    
+    def start_qr_warmup(self):
+        threading.Thread(target=self.warm_qr_codes, name="qr-warmup", daemon=True).start()
 
 premium_bot = PremiumBot()
 
@@ -263,7 +411,7 @@ def log_important_event(event_type, user_data=None, plan=None):
         else:
             return
         
-        bot.send_message(settings['log_channel'], log_msg, parse_mode="HTML")
+        outbound.post(bot.send_message, current_settings()['log_channel'], log_msg, parse_mode="HTML")
     except Exception as e:
         logging.error(f"Log error: {e}")
 
@@ -275,19 +423,29 @@ def handle_start(message):
         
         spam_result = check_spam(user_id)
         if spam_result:
-            bot.send_message(message.chat.id, spam_result, parse_mode="HTML")
+            outbound.offer(bot.send_message, message.chat.id, spam_result, parse_mode="HTML")
             return
         
-        is_new_user = str(user_id) not in users_data
-        
-        users_data[str(user_id)] = {
-            'id': user_id,
-            'username': message.from_user.username,
-            'first_name': message.from_user.first_name,
-            'last_name': message.from_user.last_name or "",
-            'start_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'is_premium': False
-        }
+        with user_locks.lock_for(user_id):
+            is_new_user = str(user_id) not in users_data
+            
+            if is_new_user:
+                users_data[str(user_id)] = UserRecord(
+                    id=user_id,
+                    username=message.from_user.username,
+                    first_name=message.from_user.first_name,
+                    last_name=message.from_user.last_name or "",
+                    is_premium=False
+                )
+            else:
+                # Keep premium status and first-seen time, refresh the profile
+                user = users_data[str(user_id)]
+                user.username = message.from_user.username
+                user.first_name = message.from_user.first_name
+                user.last_name = message.from_user.last_name or ""
+                # Talking to the bot again means the chat is reachable
+                user.inactive_since = None
+        save_users_data(user_id)
         
         reset_spam_counter(user_id)
         
@@ -334,25 +492,9 @@ def handle_start(message):
         logging.error(f"Start error: {e}")
 
 def send_default_start(message):
-    welcome_text = f"""
-<b>🔥 PREMIUM CONTENT 🔥</b>
-
-<b>Membership Plans:</b>
-📅 {PLANS['monthly']['name']} - ₹{PLANS['monthly']['amount']}
-♾️ {PLANS['lifetime']['name']} - ₹{PLANS['lifetime']['amount']}
-
-<b>Features:</b>
-• 55k+ Premium Videos
-• Lifetime Access (Lifetime plan)
-• Fast Support
-• Daily Updates
-
-<b>👇 Choose your plan:</b>
-    """
-    
     bot.send_message(
         message.chat.id,
-        welcome_text,
+        current_settings().texts["welcome"],
         reply_markup=verif.plan_selection_keyboard(),
         parse_mode="HTML"
     )
@@ -365,27 +507,33 @@ def handle_plan_selection(call):
     
     spam_result = check_spam(user_id)
     if spam_result:
-        bot.send_message(chat_id, spam_result, parse_mode="HTML")
+        outbound.offer(bot.send_message, chat_id, spam_result, parse_mode="HTML")
         bot.answer_callback_query(call.id)
         return
     
     reset_spam_counter(user_id)
     
     plan_type = call.data.split('_')[1]  # monthly or lifetime
-    plan = PLANS[plan_type]
+    snapshot = current_settings()
+    plan = snapshot.plans[plan_type]
     
     # Store in pending verifications
-    pending_verifications[str(user_id)] = {
-        'plan': plan_type,
-        'amount': plan['amount'],
-        'initiated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'username': call.from_user.username,
-        'first_name': call.from_user.first_name
-    }
-    save_json_file(PENDING_VERIF_FILE, pending_verifications)
+    with user_locks.lock_for(user_id):
+        pending_verifications[str(user_id)] = {
+            'plan': plan_type,
+            'amount': plan['amount'],
+            'initiated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'username': call.from_user.username,
+            'first_name': call.from_user.first_name
+        }
+        user = users_data.get(str(user_id))
+        if user is not None:
+            user.payment_initiated = int(time.time())
+    save_pending_verifications(user_id)
     
     # Log payment initiation
-    if str(user_id) in users_data:
+    if user is not None:
+        save_users_data(user_id)
         log_important_event("payment_initiated", users_data[str(user_id)], plan['name'])
     
     # Delete previous message
@@ -394,56 +542,18 @@ def handle_plan_selection(call):
     except:
         pass
     
-    # Generate QR code
-    qr_image = premium_bot.generate_qr_code(settings['upi_id'], plan['amount'], settings['upi_name'])
+    keyboard = snapshot.keyboards["payment"]
     
-    if qr_image:
-        caption = f"""
-<b>💰 PAY ₹{plan['amount']} FOR {plan['name'].upper()}</b>
-
-<b>UPI Details:</b>
-└ ID: <code>{settings['upi_id']}</code>
-└ Name: {settings['upi_name']}
-└ Amount: <b>₹{plan['amount']}</b>
-
-<b>Instructions:</b>
-1. Scan QR with any UPI app
-2. Pay ₹{plan['amount']}
-3. Click "✅ Payment Done" below
-        """
-        
-        keyboard = types.InlineKeyboardMarkup(row_width=1)
-        btn1 = types.InlineKeyboardButton("✅ Payment Done", callback_data="payment_done")
-        btn2 = types.InlineKeyboardButton("📞 Support", url=f"https://t.me/{settings['support_username']}")
-        keyboard.add(btn1, btn2)
-        
-        bot.send_photo(
-            chat_id,
-            photo=qr_image,
-            caption=caption,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-    else:
-        manual_text = f"""
-<b>💰 PAY ₹{plan['amount']} FOR {plan['name'].upper()}</b>
-
-<b>UPI ID:</b> <code>{settings['upi_id']}</code>
-<b>Amount:</b> ₹{plan['amount']}
-
-<b>Steps:</b>
-1. Send ₹{plan['amount']} to above UPI ID
-2. Click "✅ Payment Done" below
-        """
-        
-        keyboard = types.InlineKeyboardMarkup(row_width=1)
-        btn1 = types.InlineKeyboardButton("✅ Payment Done", callback_data="payment_done")
-        btn2 = types.InlineKeyboardButton("📞 Support", url=f"https://t.me/{settings['support_username']}")
-        keyboard.add(btn1, btn2)
-        
+    # Cached QR: rendered and uploaded once per UPI id/amount/name
+    if not premium_bot.send_qr(
+        chat_id, snapshot['upi_id'], plan['amount'], snapshot['upi_name'],
+        caption=snapshot.texts[f"payment_caption:{plan_type}"],
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    ):
         bot.send_message(
             chat_id,
-            manual_text,
+            snapshot.texts[f"payment_manual:{plan_type}"],
             reply_markup=keyboard,
             parse_mode="HTML"
         )
@@ -457,25 +567,13 @@ def handle_how_to_get(call):
     
     spam_result = check_spam(user_id)
     if spam_result:
-        bot.send_message(call.message.chat.id, spam_result, parse_mode="HTML")
+        outbound.offer(bot.send_message, call.message.chat.id, spam_result, parse_mode="HTML")
         bot.answer_callback_query(call.id)
         return
     
     reset_spam_counter(user_id)
     
-    instructions = f"""
-<b>❓ HOW TO GET PREMIUM:</b>
-
-1. Click "Get Premium" button
-2. Choose your plan (Monthly/Lifetime)
-3. Scan QR code and pay exact amount
-4. Click "Payment Done" button
-5. Send payment screenshot
-6. Admin verifies within few minutes
-7. Get unique join link after verification
-
-<b>Support:</b> @{settings['support_username']}
-    """
+    instructions = current_settings().texts["how_to_get"]
     
     try:
         bot.edit_message_text(
@@ -502,7 +600,7 @@ def handle_get_premium(call):
     
     spam_result = check_spam(user_id)
     if spam_result:
-        bot.send_message(call.message.chat.id, spam_result, parse_mode="HTML")
+        outbound.offer(bot.send_message, call.message.chat.id, spam_result, parse_mode="HTML")
         bot.answer_callback_query(call.id)
         return
     
@@ -510,7 +608,7 @@ def handle_get_premium(call):
     
     try:
         bot.edit_message_text(
-            "👇 <b>Choose your membership plan:</b>",
+            current_settings().texts["choose_plan"],
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             reply_markup=verif.plan_selection_keyboard(),
@@ -519,7 +617,7 @@ def handle_get_premium(call):
     except:
         bot.send_message(
             call.message.chat.id,
-            "👇 <b>Choose your membership plan:</b>",
+            current_settings().texts["choose_plan"],
             reply_markup=verif.plan_selection_keyboard(),
             parse_mode="HTML"
         )
@@ -534,7 +632,7 @@ def handle_payment_done(call):
     
     spam_result = check_spam(user_id)
     if spam_result:
-        bot.send_message(chat_id, spam_result, parse_mode="HTML")
+        outbound.offer(bot.send_message, chat_id, spam_result, parse_mode="HTML")
         bot.answer_callback_query(call.id)
         return
     
@@ -560,6 +658,23 @@ def handle_payment_done(call):
     
     bot.answer_callback_query(call.id)
 
+# ========== BROADCAST ALBUMS ==========
+# Albums arrive as one message per item. Remember the admin's recent ones
+# so replying /broadcast to any item can send the whole album.
+broadcast_albums = OrderedDict()  # media_group_id -> [{"message_id", "media"}]
+MAX_BROADCAST_ALBUMS = 20
+
+@bot.message_handler(
+    func=lambda message: message.media_group_id is not None and str(message.from_user.id) == ADMIN_ID,
+    content_types=['photo', 'video', 'document', 'audio']
+)
+def handle_album_item(message):
+    items = broadcast_albums.setdefault(message.media_group_id, [])
+    broadcast_albums.move_to_end(message.media_group_id)
+    items.append({"message_id": message.message_id, "media": fallback_content(message)})
+    while len(broadcast_albums) > MAX_BROADCAST_ALBUMS:
+        broadcast_albums.popitem(last=False)
+
 # ========== HANDLE SCREENSHOTS ==========
 @bot.message_handler(content_types=['photo'])
 def handle_photos(message):
@@ -652,26 +767,27 @@ def handle_settings(message):
     if str(message.from_user.id) != ADMIN_ID:
         return
     
+    snapshot = current_settings()
     text = f"""
 <b>⚙️ CURRENT SETTINGS</b>
 
-<b>📢 Demo Channel:</b> {settings['demo_channel_link']}
-<b>📞 Support Username:</b> @{settings['support_username']}
-<b>📋 Log Channel:</b> {settings['log_channel']}
+<b>📢 Demo Channel:</b> {snapshot['demo_channel_link']}
+<b>📞 Support Username:</b> @{snapshot['support_username']}
+<b>📋 Log Channel:</b> {snapshot['log_channel']}
 
 <b>💰 UPI Settings:</b>
-• UPI ID: <code>{settings['upi_id']}</code>
-• UPI Name: {settings['upi_name']}
+• UPI ID: <code>{snapshot['upi_id']}</code>
+• UPI Name: {snapshot['upi_name']}
 
 <b>📅 Monthly Plan:</b>
-• Name: {settings['monthly_name']}
-• Amount: ₹{settings['monthly_amount']}
-• Channel ID: <code>{settings['monthly_channel_id']}</code>
+• Name: {snapshot['monthly_name']}
+• Amount: ₹{snapshot['monthly_amount']}
+• Channel ID: <code>{snapshot['monthly_channel_id']}</code>
 
 <b>♾️ Lifetime Plan:</b>
-• Name: {settings['lifetime_name']}
-• Amount: ₹{settings['lifetime_amount']}
-• Channel ID: <code>{settings['lifetime_channel_id']}</code>
+• Name: {snapshot['lifetime_name']}
+• Amount: ₹{snapshot['lifetime_amount']}
+• Channel ID: <code>{snapshot['lifetime_channel_id']}</code>
 
 <b>To change settings, use:</b>
 /set [key] [value]
@@ -719,6 +835,10 @@ def handle_set(message):
     
     settings[key_map[key]] = value
     save_settings()
+    if key_map[key] in ("upi_id", "upi_name", "monthly_amount", "lifetime_amount"):
+        # QRs for the old values are never asked for again
+        premium_bot.qr_cache.clear()
+        premium_bot.start_qr_warmup()
     
     bot.reply_to(message, f"✅ Updated {key} to: {value}")
 
@@ -771,7 +891,7 @@ def handle_ban(message):
 📝 Reason: {reason}
 👮 Banned by: @{message.from_user.username}
                 """
-                bot.send_message(settings['log_channel'], log_msg, parse_mode="HTML")
+                bot.send_message(current_settings()['log_channel'], log_msg, parse_mode="HTML")
             except:
                 pass
         else:
@@ -798,12 +918,9 @@ def handle_unban(message):
     try:
         user_id = args[1]
         
-        if user_id in spam_data:
-            # Remove ban
-            spam_data[user_id]["blocked_until"] = 0
-            spam_data[user_id]["ban_reason"] = ""
-            spam_data[user_id]["block_level"] = 0
-            save_spam_data()
+        if ban_registry.unblock(user_id):
+            # Ban removed
+            save_spam_data(user_id)
             
             bot.reply_to(message, f"✅ User <code>{user_id}</code> unbanned successfully!", parse_mode="HTML")
             
@@ -833,8 +950,7 @@ def handle_banlist(message):
     current_time = time.time()
     banned_users = []
     
-    for user_id, data in spam_data.items():
-        blocked_until = data.get("blocked_until", 0)
+    for user_id, blocked_until, data in ban_registry.list_active(current_time):
         if blocked_until > current_time:
             time_left = int(blocked_until - current_time)
             minutes_left = time_left // 60
@@ -875,129 +991,422 @@ def handle_banlist(message):
     else:
         bot.reply_to(message, text, parse_mode="HTML")
 
+# ========== BROADCAST JOBS ==========
+# A broadcast is a job record in broadcast_jobs. The runner checkpoints its
+# position every BROADCAST_CHECKPOINT_INTERVAL seconds, so a restart picks
+# up where it stopped instead of sending to everyone again. At most the
+# sends since the last checkpoint can be repeated.
+broadcast_runs = {}  # job_id -> BroadcastEngine for jobs running in this process
+broadcast_jobs_lock = threading.Lock()
+broken_copy_sources = set()  # (chat_id, message_id) that copyMessage refused
+
+def new_broadcast_stats():
+    return {BROADCAST_SENT: 0, BROADCAST_FAILED: 0, BROADCAST_UNREACHABLE: 0, BROADCAST_SKIPPED: 0, "retried": 0}
+
+def fallback_content(msg):
+    """Per-type resend of a message, used when copying it fails"""
+    caption = msg.html_caption or ""
+    if msg.photo:
+        return {"type": "photo", "file_id": msg.photo[-1].file_id, "caption": caption}
+    if msg.video:
+        return {"type": "video", "file_id": msg.video.file_id, "caption": caption}
+    if msg.document:
+        return {"type": "document", "file_id": msg.document.file_id, "caption": caption}
+    if msg.animation:
+        return {"type": "animation", "file_id": msg.animation.file_id, "caption": caption}
+    if msg.audio:
+        return {"type": "audio", "file_id": msg.audio.file_id, "caption": caption}
+    if msg.text:
+        return {"type": "text", "text": msg.html_text}
+    if msg.caption:
+        return {"type": "text", "text": caption}
+    return None
+
+def broadcast_content(msg):
+    """What to send, taken from the message the admin replied to: a copy of
+    the message itself, or of its whole album if the album was captured"""
+    album = broadcast_albums.get(msg.media_group_id) if msg.media_group_id else None
+    if album:
+        items = sorted(album, key=lambda item: item["message_id"])
+        return {
+            "type": "album",
+            "from_chat": msg.chat.id,
+            "message_ids": [item["message_id"] for item in items],
+            "media": [item["media"] for item in items]
+        }
+    return {
+        "type": "copy",
+        "from_chat": msg.chat.id,
+        "message_id": msg.message_id,
+        "fallback": fallback_content(msg)
+    }
+
+# Descriptions Telegram gives when the source message itself can't be copied
+COPY_SOURCE_ERRORS = (
+    "message to copy not found",
+    "message can't be copied",
+    "messages to copy not found",
+    "message_ids_invalid",
+)
+
+def copy_unavailable(error):
+    """True if copying failed because of the source message, not the recipient"""
+    description = str(getattr(error, "description", "") or error).lower()
+    return getattr(error, "error_code", None) == 400 and any(reason in description for reason in COPY_SOURCE_ERRORS)
+
+def album_media(media):
+    input_types = {
+        "photo": types.InputMediaPhoto,
+        "video": types.InputMediaVideo,
+        "document": types.InputMediaDocument,
+        "audio": types.InputMediaAudio
+    }
+    return [
+        input_types[item["type"]](item["file_id"], caption=item["caption"] or None, parse_mode="HTML")
+        for item in media
+    ]
+
+def broadcast_call(content, user_id):
+    """(method name, args, kwargs, fallback content, source) delivering
+    `content`; the fallback is tried if Telegram refuses to copy `source`"""
+    kind = content["type"]
+    
+    if kind == "copy":
+        source = (content["from_chat"], content["message_id"])
+        if source not in broken_copy_sources or not content["fallback"]:
+            return "copy_message", (user_id, content["from_chat"], content["message_id"]), {}, content["fallback"], source
+        # Source deleted or not copyable: resend by type
+        return broadcast_call(content["fallback"], user_id)
+    if kind == "album":
+        source = (content["from_chat"], content["message_ids"][0])
+        fallback = {"type": "media_group", "media": content["media"]}
+        if source not in broken_copy_sources:
+            return "copy_messages", (user_id, content["from_chat"], content["message_ids"]), {}, fallback, source
+        return broadcast_call(fallback, user_id)
+    if kind == "media_group":
+        return "send_media_group", (user_id, album_media(content["media"])), {}, None, None
+    
+    # Send based on type
+    if kind in ("photo", "video", "document", "animation", "audio"):
+        kwargs = {kind: content["file_id"], "caption": content["caption"], "parse_mode": "HTML"}
+        return f"send_{kind}", (user_id,), kwargs, None, None
+    return "send_message", (user_id, content["text"]), {"parse_mode": "HTML"}, None, None
+
+def send_broadcast(content, user_id):
+    """Broadcast sends queue behind user replies and log messages"""
+    with outbound.priority(BROADCAST):
+        send_broadcast_content(content, user_id)
+
+def send_broadcast_content(content, user_id):
+    name, args, kwargs, fallback, source = broadcast_call(content, int(user_id))
+    try:
+        getattr(bot, name)(*args, **kwargs)
+    except Exception as e:
+        if fallback is None or not copy_unavailable(e):
+            raise
+        broken_copy_sources.add(source)
+        send_broadcast_content(fallback, user_id)
+
+async def send_broadcast_async(content, user_id):
+    """send_broadcast on the async engine: the outbound scheduler sets the
+    pace (waiting on the loop, not in an executor thread), the call itself
+    is awaited on the shared session"""
+    wait = outbound.try_acquire(user_id, BROADCAST)
+    while wait:
+        await asyncio.sleep(wait)
+        wait = outbound.try_acquire(user_id, BROADCAST)
+    name, args, kwargs, fallback, source = broadcast_call(content, int(user_id))
+    try:
+        await getattr(async_engine.api, name)(*args, **kwargs)
+    except Exception as e:
+        seconds = retry_after(e)
+        if seconds:
+            outbound.pause(seconds)
+        if fallback is None or not copy_unavailable(e):
+            raise
+        broken_copy_sources.add(source)
+        await send_broadcast_async(fallback, user_id)
+
+def mark_unreachable(user_id):
+    """Flag a user whose chat is gone; broadcasts skip them until the next /start"""
+    uid = str(user_id)
+    with user_locks.lock_for(uid):
+        user = users_data.get(uid)
+        if user is None or user.inactive_since:
+            return
+        user.inactive_since = int(time.time())
+    save_users_data(uid)
+
+def on_broadcast_result(checkpoint, user_id, outcome):
+    checkpoint.mark(user_id)
+    if outcome == BROADCAST_UNREACHABLE:
+        mark_unreachable(user_id)
+
+def update_broadcast_job(job_id, **fields):
+    """Replace the job record (never mutated in place) and queue its save"""
+    with broadcast_jobs_lock:
+        job = dict(broadcast_jobs[job_id], updated=int(time.time()), **fields)
+        broadcast_jobs[job_id] = job
+    save_broadcast_jobs(job_id)
+    return job
+
+def broadcast_targets(job):
+    """Sorted ids of the job's segment, limited to users who were already
+    there when the job was created"""
+    return segments.select(job.get("segment", "all"), joined_before=job["created"])
+
+def broadcast_job_text(job):
+    stats = job["stats"]
+    finished = stats[BROADCAST_SENT] + stats[BROADCAST_FAILED] + stats[BROADCAST_UNREACHABLE] + stats[BROADCAST_SKIPPED]
+    percent = int(finished / job["total"] * 100) if job["total"] else 100
+    titles = {
+        "running": "📤 <b>Broadcasting...</b>",
+        "paused": "⏸️ <b>BROADCAST PAUSED</b>",
+        "cancelled": "🛑 <b>BROADCAST CANCELLED</b>",
+        "done": "✅ <b>BROADCAST COMPLETE!</b>"
+    }
+    return f"""
+{titles.get(job['status'], job['status'])} <code>#{job['id']}</code> - {percent}%
+🎯 Segment: <code>{job.get('segment', 'all')}</code>
+
+📊 <b>Results:</b>
+• ✅ Sent: {stats[BROADCAST_SENT]}
+• ❌ Failed: {stats[BROADCAST_FAILED]}
+• 🚫 Unreachable (pruned): {stats[BROADCAST_UNREACHABLE]}
+• ⏭️ Skipped: {stats[BROADCAST_SKIPPED]}
+• 🔁 Retries: {stats['retried']}
+• 👥 Total: {job['total']}
+    """
+
+def show_broadcast_job(job):
+    try:
+        bot.edit_message_text(
+            broadcast_job_text(job), 
+            chat_id=job["admin_chat"], 
+            message_id=job["progress_msg"], 
+            parse_mode="HTML"
+        )
+    except:
+        pass
+
+def run_broadcast_job(job_id):
+    """Deliver a job from its last checkpoint (blocking)"""
+    job = broadcast_jobs[job_id]
+    checkpoint = Checkpoint(broadcast_targets(job), job.get("cursor"), job.get("done", []))
+    base = job["stats"]
+    
+    def merged(stats):
+        return {key: base.get(key, 0) + stats.get(key, 0) for key in base}
+    
+    def save_checkpoint(stats):
+        cursor, done = checkpoint.snapshot()
+        show_broadcast_job(update_broadcast_job(job_id, cursor=cursor, done=done, stats=merged(stats)))
+    
+    options = dict(
+        rate=BROADCAST_RATE,
+        skip=ban_registry.is_blocked,
+        on_result=lambda user_id, outcome, detail: on_broadcast_result(checkpoint, user_id, outcome),
+        on_progress=save_checkpoint,
+        progress_interval=BROADCAST_CHECKPOINT_INTERVAL
+    )
+    if async_engine and async_engine.ready.is_set():
+        engine = AsyncBroadcastEngine(
+            async_engine.loop,
+            lambda user_id: send_broadcast_async(job["content"], user_id),
+            workers=ASYNC_BROADCAST_CONCURRENCY,
+            **dict(options, rate=None)  # paced by outbound.try_acquire alone
+        )
+    else:
+        engine = BroadcastEngine(
+            lambda user_id: send_broadcast(job["content"], user_id),
+            workers=BROADCAST_WORKERS,
+            **options
+        )
+    broadcast_runs[job_id] = engine
+    if broadcast_jobs[job_id]["status"] == "paused":
+        engine.pause()
+    try:
+        stats = engine.run(checkpoint.pending())
+        cursor, done = checkpoint.snapshot()
+        fields = {"cursor": cursor, "done": done, "stats": merged(stats)}
+        if not engine.cancelled:
+            fields.update(status="done", done=[])
+        show_broadcast_job(update_broadcast_job(job_id, **fields))
+    except Exception as e:
+        logging.error(f"Broadcast job {job_id} error: {e}")
+    finally:
+        broadcast_runs.pop(job_id, None)
+
+def start_broadcast_job(job_id):
+    thread = threading.Thread(target=run_broadcast_job, args=(job_id,), daemon=True)
+    thread.start()
+
+def resume_broadcast_jobs():
+    """Restart jobs that were running when the bot stopped"""
+    for job_id, job in list(broadcast_jobs.items()):
+        if job.get("status") == "running" and job_id not in broadcast_runs:
+            logging.info(f"Resuming broadcast job {job_id}")
+            start_broadcast_job(job_id)
+
+def find_broadcast_job(message):
+    """Job id from the command argument, else the newest unfinished job"""
+    parts = message.text.split()
+    if len(parts) > 1:
+        job_id = parts[1].lstrip('#')
+        return job_id if job_id in broadcast_jobs else None
+    active = [job_id for job_id, job in broadcast_jobs.items() if job.get("status") in ("running", "paused")]
+    return max(active, key=int) if active else None
+
 # ========== /BROADCAST COMMAND ==========
 @bot.message_handler(commands=['broadcast'])
 def handle_broadcast(message):
-    """Broadcast message to all users"""
+    """Broadcast message to all users or to a segment"""
     if str(message.from_user.id) != ADMIN_ID:
         return
     
     if not message.reply_to_message:
-        help_text = """
+        counts = segments.counts()
+        segment_list = "\n".join(f"• <code>{name}</code>: {count}" for name, count in counts.items())
+        help_text = f"""
 <b>📢 BROADCAST COMMAND</b>
 
-<code>Reply to any message with /broadcast</code>
+<code>Reply to any message with /broadcast [segment]</code>
 
-<b>Supported:</b> Text, Photos, Videos, Documents, GIFs
+<b>Supported:</b> Any message, including albums (reply to any album item)
 
 <b>How to use:</b>
 1. Send the message you want to broadcast
 2. Reply to it with <code>/broadcast</code>
+
+<b>Segments:</b>
+{segment_list}
+• <code>joined:2024-01-01..2024-01-31</code>
+Combine terms to intersect: <code>/broadcast free joined:2024-01-01..</code>
+
+<b>Manage:</b> /bcstatus /bcpause /bcresume /bccancel
         """
         bot.reply_to(message, help_text, parse_mode="HTML")
         return
     
-    replied_msg = message.reply_to_message
+    segment = " ".join(message.text.split()[1:]) or "all"
+    created = int(time.time())
+    try:
+        total_users = len(segments.select(segment, joined_before=created))
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {e}")
+        return
+    
+    content = broadcast_content(message.reply_to_message)
     progress_msg = bot.reply_to(message, "📤 <b>Broadcast Starting...</b>", parse_mode="HTML")
     
-    total_users = len(users_data)
     if total_users == 0:
         bot.edit_message_text("❌ No users to broadcast", chat_id=message.chat.id, message_id=progress_msg.message_id)
         return
     
-    def broadcast_thread():
-        sent = 0
-        failed = 0
-        skipped = 0
-        user_ids = list(users_data.keys())
-        
-        for idx, user_id_str in enumerate(user_ids):
-            try:
-                user_id = int(user_id_str)
-                
-                # Skip if blocked
-                if user_id_str in spam_data:
-                    if spam_data[user_id_str].get("blocked_until", 0) > time.time():
-                        skipped += 1
-                        continue
-                
-                # Send based on type
-                if replied_msg.photo:
-                    bot.send_photo(
-                        user_id, 
-                        photo=replied_msg.photo[-1].file_id, 
-                        caption=replied_msg.caption or "", 
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.video:
-                    bot.send_video(
-                        user_id, 
-                        video=replied_msg.video.file_id, 
-                        caption=replied_msg.caption or "", 
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.document:
-                    bot.send_document(
-                        user_id, 
-                        document=replied_msg.document.file_id, 
-                        caption=replied_msg.caption or "", 
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.animation:
-                    bot.send_animation(
-                        user_id, 
-                        animation=replied_msg.animation.file_id, 
-                        caption=replied_msg.caption or "", 
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.text:
-                    bot.send_message(user_id, replied_msg.text, parse_mode="HTML")
-                elif replied_msg.caption:
-                    bot.send_message(user_id, replied_msg.caption, parse_mode="HTML")
-                
-                sent += 1
-                
-                # Update progress every 10 users
-                if idx % 10 == 0:
-                    percent = int((idx + 1) / total_users * 100)
-                    try:
-                        bot.edit_message_text(
-                            f"📤 Broadcasting... {percent}% ({sent} sent, {failed} failed)", 
-                            chat_id=message.chat.id, 
-                            message_id=progress_msg.message_id
-                        )
-                    except:
-                        pass
-                
-                time.sleep(0.1)  # Rate limit protection
-                
-            except Exception as e:
-                failed += 1
-        
-        final_text = f"""
-✅ <b>BROADCAST COMPLETE!</b>
+    job_id = str(int(time.time() * 1000))
+    job = {
+        "id": job_id,
+        "status": "running",
+        "segment": segment,
+        "created": created,
+        "updated": int(time.time()),
+        "admin_chat": message.chat.id,
+        "progress_msg": progress_msg.message_id,
+        "content": content,
+        "total": total_users,
+        "cursor": None,
+        "done": [],
+        "stats": new_broadcast_stats()
+    }
+    with broadcast_jobs_lock:
+        broadcast_jobs[job_id] = job
+    save_broadcast_jobs(job_id)
+    # The job must survive a restart before the first message goes out
+    flush_writes()
+    
+    start_broadcast_job(job_id)
+    
+    bot.reply_to(message, f"📢 Broadcast <code>#{job_id}</code> started to {total_users} users ({segment})!", parse_mode="HTML")
 
-📊 <b>Results:</b>
-• ✅ Sent: {sent}
-• ❌ Failed: {failed}
-• ⏭️ Skipped: {skipped}
-• 👥 Total: {total_users}
-        """
-        
-        try:
-            bot.edit_message_text(
-                final_text, 
-                chat_id=message.chat.id, 
-                message_id=progress_msg.message_id, 
-                parse_mode="HTML"
-            )
-        except:
-            pass
+@bot.message_handler(commands=['bcstatus'])
+def handle_bcstatus(message):
+    """Show recent broadcast jobs"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
     
-    thread = threading.Thread(target=broadcast_thread)
-    thread.start()
+    if len(message.text.split()) > 1:
+        job_id = find_broadcast_job(message)
+        if not job_id:
+            bot.reply_to(message, "❌ Broadcast job not found")
+            return
+        bot.reply_to(message, broadcast_job_text(broadcast_jobs[job_id]), parse_mode="HTML")
+        return
     
-    bot.reply_to(message, f"📢 Broadcast started to {total_users} users!")
+    jobs = sorted(broadcast_jobs.values(), key=lambda job: int(job["id"]), reverse=True)[:5]
+    if not jobs:
+        bot.reply_to(message, "📭 No broadcast jobs")
+        return
+    
+    text = "📢 <b>BROADCAST JOBS</b>\n"
+    for job in jobs:
+        text += broadcast_job_text(job)
+    bot.reply_to(message, text, parse_mode="HTML")
+
+@bot.message_handler(commands=['bcpause'])
+def handle_bcpause(message):
+    """Pause a running broadcast job"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    job_id = find_broadcast_job(message)
+    if not job_id or broadcast_jobs[job_id]["status"] != "running":
+        bot.reply_to(message, "❌ No running broadcast job")
+        return
+    
+    update_broadcast_job(job_id, status="paused")
+    engine = broadcast_runs.get(job_id)
+    if engine:
+        engine.pause()
+    bot.reply_to(message, f"⏸️ Broadcast <code>#{job_id}</code> paused", parse_mode="HTML")
+
+@bot.message_handler(commands=['bcresume'])
+def handle_bcresume(message):
+    """Resume a paused broadcast job"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    job_id = find_broadcast_job(message)
+    if not job_id or broadcast_jobs[job_id]["status"] not in ("running", "paused"):
+        bot.reply_to(message, "❌ No paused broadcast job")
+        return
+    
+    update_broadcast_job(job_id, status="running")
+    engine = broadcast_runs.get(job_id)
+    if engine:
+        engine.resume()
+    else:
+        # Paused before a restart: nothing is running it yet
+        start_broadcast_job(job_id)
+    bot.reply_to(message, f"▶️ Broadcast <code>#{job_id}</code> resumed", parse_mode="HTML")
+
+@bot.message_handler(commands=['bccancel'])
+def handle_bccancel(message):
+    """Cancel a broadcast job"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    job_id = find_broadcast_job(message)
+    if not job_id or broadcast_jobs[job_id]["status"] not in ("running", "paused"):
+        bot.reply_to(message, "❌ No active broadcast job")
+        return
+    
+    job = update_broadcast_job(job_id, status="cancelled")
+    engine = broadcast_runs.get(job_id)
+    if engine:
+        engine.cancel()
+    else:
+        show_broadcast_job(job)
+    bot.reply_to(message, f"🛑 Broadcast <code>#{job_id}</code> cancelled", parse_mode="HTML")
 
 # ========== /STATS COMMAND ==========
 @bot.message_handler(commands=['stats'])
@@ -1006,35 +1415,80 @@ def handle_stats(message):
     if str(message.from_user.id) != ADMIN_ID:
         return
     
-    current_time = time.time()
-    blocked_users = sum(1 for u in spam_data.values() if u.get("blocked_until", 0) > current_time)
+    snapshot = current_settings()
+    plans = snapshot.plans
+    blocked_users = ban_registry.count_active()
     pending_count = len(pending_verifications)
     
-    today = datetime.now().strftime('%Y-%m-%d')
-    new_today = sum(1 for u in users_data.values() if u.get('start_time', '').startswith(today))
-    
-    # Count premium users
-    premium_users = sum(1 for u in users_data.values() if u.get('is_premium', False))
+    # From the segment index, kept up to date on every save: no scan of
+    # users_data (which would load every shard)
+    segment_counts = segments.counts()
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    new_today = segments.joined_count(int(midnight.timestamp()))
+    premium_users = segment_counts['premium']
+    inactive_users = len(users_data) - segment_counts['all']
+    outbound_stats = outbound.stats()
+    if webhook_ingest:
+        hook = webhook_ingest.stats()
+        update_source = (f"Webhook ({'registered' if hook['registered'] else 'not registered'}): "
+                         f"{hook['received']} received, {hook['depth']} queued, "
+                         f"{hook['rejected']} rejected (queue full), {hook['errors']} errors")
+    else:
+        update_source = f"Polling ({'async' if async_engine else 'threads'} engine)"
+    qr_stats = premium_bot.qr_cache.stats()
+    shed = admission.stats()
+    overloaded = ", ".join(
+        f"{lane} since {datetime.fromtimestamp(since).strftime('%H:%M:%S')}"
+        for lane, since in shed['overloaded_since'].items() if since
+    )
+    lane_lines = "\n".join(
+        f"• {lane.title()}: {lane_stats['depth']} queued (peak {lane_stats['peak']}), "
+        f"{lane_stats['processed']} done, {lane_stats['avg_wait_ms']:.0f} ms avg wait, {lane_stats['workers']} workers"
+        for lane, lane_stats in dispatcher.stats().items()
+    )
     
     stats_text = f"""
 <b>📊 BOT STATISTICS</b>
 
 👥 <b>Users:</b>
 • Total Users: {len(users_data)}
-• Premium Users: {premium_users}
-• New Today: {new_today}
+• Active Users: {len(users_data) - inactive_users}
+• Inactive (unreachable): {inactive_users}
+• Premium Users (active): {premium_users}
+• New Today (active): {new_today}
 • Pending Verification: {pending_count}
 
 🛡️ <b>Spam Protection:</b>
 • Currently Blocked: {blocked_users}
-• Tracked Users: {len(spam_data)}
+• Ban Records: {len(spam_data)}
+• Active Rate Windows: {len(spam_limiter)}
 
 💰 <b>Payment Info:</b>
-• Monthly: ₹{PLANS['monthly']['amount']}
-• Lifetime: ₹{PLANS['lifetime']['amount']}
+• Monthly: ₹{plans['monthly']['amount']}
+• Lifetime: ₹{plans['lifetime']['amount']}
+• Settings Version: {snapshot.version}
 
 📁 <b>Storage:</b>
+• Backend: {STORAGE_BACKEND}
 • Data Files: {len(os.listdir(DATA_DIR))}
+• Flushes: {persist_metrics['flushes']} (skipped clean: {persist_metrics['skipped']})
+• Last Flush: {persist_metrics['last_keys']} entries, {persist_metrics['last_bytes']} bytes, {persist_metrics['last_duration_ms']:.1f} ms
+• Total Written: {persist_metrics['total_bytes'] // 1024} KB
+• Handler Saves: {writer.submitted} queued → {writer.written} writes
+
+🚦 <b>Update Lanes:</b>
+• Source: {update_source}
+{lane_lines}
+• Shed: {shed['duplicate_start']} repeat /start, {shed['repeat_callback']} repeat callbacks, {shed['overflow']} overflow
+• Overloaded: {overloaded or 'no'}
+
+📡 <b>Outbound API:</b>
+• Calls: {outbound_stats['calls']} ({outbound_stats['queued']} queued, {outbound_stats['wait_ms'] / 1000:.1f}s total wait)
+• Waiting: {outbound_stats['waiting']['reply']} reply / {outbound_stats['waiting']['log']} log / {outbound_stats['waiting']['broadcast']} broadcast
+• 429s: {outbound_stats['rate_limited']} • Log backlog: {outbound_stats['backlog']} (dropped {outbound_stats['dropped']}) • Spam replies skipped: {outbound_stats['skipped']}
+• Payment QRs: {qr_stats['renders']} rendered, {qr_stats['uploads']} uploaded, {qr_stats['file_id_hits']} sent by file_id
+
+⏱️ <b>{startup_report}</b>
 
 🚀 <b>Status:</b> ✅ Running
     """
@@ -1053,9 +1507,9 @@ def handle_export_data(message):
         export_data = {
             "export_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "total_users": len(users_data),
-            "users": users_data,
-            "spam_data": spam_data,
-            "pending": pending_verifications
+            "users": dict(users_data),
+            "spam_data": dict(spam_data),
+            "pending": dict(pending_verifications)
         }
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -1063,7 +1517,7 @@ def handle_export_data(message):
         filepath = os.path.join(DATA_DIR, filename)
         
         with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(export_data, f, indent=4)
+            json.dump(export_data, f, indent=4, default=to_plain)
         
         with open(filepath, 'rb') as f:
             bot.send_document(
@@ -1119,12 +1573,14 @@ def handle_impdata(message):
             data_to_import = imported_data
         
         for user_id_str, user_data in data_to_import.items():
-            if user_id_str in users_data:
-                users_data[user_id_str].update(user_data)
-                updated_count += 1
-            else:
-                users_data[user_id_str] = user_data
-                imported_count += 1
+            with user_locks.lock_for(user_id_str):
+                if user_id_str in users_data:
+                    users_data[user_id_str].update(user_data)
+                    users_data.touch(user_id_str)
+                    updated_count += 1
+                else:
+                    users_data[user_id_str] = UserRecord.from_dict(user_data)
+                    imported_count += 1
         
         save_users_data()
         os.remove(temp_path)
@@ -1161,9 +1617,9 @@ def handle_backup(message):
     
     try:
         backup_data = {
-            "users": users_data,
-            "spam": spam_data,
-            "pending": pending_verifications,
+            "users": dict(users_data),
+            "spam": dict(spam_data),
+            "pending": dict(pending_verifications),
             "backup_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         
@@ -1172,7 +1628,7 @@ def handle_backup(message):
         backup_path = os.path.join(DATA_DIR, backup_file)
         
         with open(backup_path, 'w') as f:
-            json.dump(backup_data, f, indent=4)
+            json.dump(backup_data, f, indent=4, default=to_plain)
         
         with open(backup_path, 'rb') as f:
             bot.send_document(
@@ -1240,6 +1696,29 @@ def handle_clean_backups(message):
     except Exception as e:
         bot.reply_to(message, f"❌ Cleanup failed: {str(e)}")
 
+# ========== /SWEEP COMMAND ==========
+@bot.message_handler(commands=['sweep'])
+def handle_sweep(message):
+    """Run the state sweeper now"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    try:
+        report = sweep_state()
+        result_msg = f"""
+🧹 <b>SWEEP COMPLETE</b>
+
+🛡️ Spam entries dropped: {report['spam_entries']}
+🔗 Invite links archived: {report['links_archived']}
+📤 Old broadcast jobs dropped: {report['broadcast_jobs']}
+⏱️ Idle rate windows freed: {report['rate_windows']}
+💾 Reclaimed: {report['bytes'] // 1024} KB ({report['bytes']} bytes)
+⏰ Took: {report['duration_ms']:.0f} ms
+        """
+        bot.reply_to(message, result_msg, parse_mode="HTML")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Sweep failed: {str(e)}")
+
 # ========== /SETSTARTMSG COMMAND ==========
 @bot.message_handler(commands=['setstartmsg'])
 def handle_set_start_message(message):
@@ -1306,8 +1785,8 @@ def handle_clear_start_message(message):
     if str(message.from_user.id) != ADMIN_ID:
         return
     
-    global start_message_data
-    start_message_data = {}
+    # Clear in place so config's reference (and its dirty tracking) stays valid
+    start_message_data.clear()
     save_start_message()
     bot.reply_to(message, "✅ Custom start message cleared")
 
@@ -1322,9 +1801,10 @@ def handle_pending(message):
         bot.reply_to(message, "✅ No pending verifications")
         return
     
+    plans = current_settings().plans
     text = "<b>⏳ PENDING VERIFICATIONS:</b>\n\n"
     for uid, data in pending_verifications.items():
-        plan = PLANS[data['plan']]['name']
+        plan = plans[data['plan']]['name']
         text += f"👤 ID: <code>{uid}</code>\n"
         text += f"📅 Plan: {plan}\n"
         text += f"💰 Amount: ₹{data['amount']}\n"
@@ -1346,6 +1826,7 @@ def handle_help(message):
     """Show help message"""
     if str(message.from_user.id) != ADMIN_ID:
         # User help
+        snapshot = current_settings()
         user_help = f"""
 <b>🤖 Bot Commands:</b>
 
@@ -1354,8 +1835,8 @@ def handle_help(message):
 
 For premium: Click "Get Premium" button
 
-<b>Demo Channel:</b> {settings['demo_channel_link']}
-<b>Support:</b> @{settings['support_username']}
+<b>Demo Channel:</b> {snapshot['demo_channel_link']}
+<b>Support:</b> @{snapshot['support_username']}
         """
         bot.reply_to(message, user_help, parse_mode="HTML")
         return
@@ -1378,7 +1859,11 @@ For premium: Click "Get Premium" button
 /banlist - Show banned users
 
 <b>📢 BROADCAST:</b>
-/broadcast (reply) - Broadcast message
+/broadcast (reply) [segment] - Broadcast message
+/bcstatus [id] - Broadcast job progress
+/bcpause [id] - Pause broadcast
+/bcresume [id] - Resume broadcast
+/bccancel [id] - Cancel broadcast
 
 <b>📊 DATA:</b>
 /stats - Bot statistics
@@ -1387,6 +1872,7 @@ For premium: Click "Get Premium" button
 /backup - Create backup
 /savedata - Force save
 /cleanbackups - Clean old backups
+/sweep - Prune stale spam/invite data
 
 <b>✏️ START MESSAGE:</b>
 /setstartmsg (reply) - Set custom start
@@ -1411,7 +1897,55 @@ def handle_all_messages(message):
     # Ignore all other messages
     pass
 
+startup_stage("handlers")
+startup_report = f"Startup ready in {startup_total_ms():.0f} ms (" + ", ".join(
+    f"{stage} {ms:.0f} ms" for stage, ms in startup_timings.items()
+) + ")"
+logging.info(startup_report)
+
 # ========== START BOT ==========
+def run_polling():
+    """Resume broadcasts and poll for updates with the configured engine (blocking)"""
+    if WEBHOOK_URL:
+        # Polling would remove the webhook the web app registered
+        logging.error("WEBHOOK_URL is set: updates come through the web app (gunicorn app:app), not polling")
+        return
+    premium_bot.start_qr_warmup()
+    try:
+        # getUpdates is refused while a webhook is set
+        bot.remove_webhook()
+    except Exception as e:
+        logging.error(f"Could not remove webhook: {e}")
+    if async_engine:
+        # Broadcasts resume once the loop is up (on_ready)
+        async_engine.run()
+    else:
+        resume_broadcast_jobs()
+        bot.infinity_polling()
+
+# Webhook mode (WEBHOOK_URL set): app.py feeds POSTed updates to webhook_ingest
+webhook_ingest = None
+webhook_secret = WEBHOOK_SECRET
+
+def start_webhook():
+    """Start webhook ingestion and, in the background, register the webhook
+    and resume broadcasts. Returns the ingest queue app.py feeds."""
+    global webhook_ingest
+    if not webhook_secret:
+        # A per-process random secret would differ between web workers and
+        # across restarts, and every other process would answer 403
+        raise RuntimeError("Webhook mode needs WEBHOOK_SECRET")
+    webhook_ingest = WebhookIngest(bot, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS)
+    webhook_ingest.start()
+    
+    def boot():
+        premium_bot.start_qr_warmup()
+        webhook_ingest.register(f"{WEBHOOK_URL}/webhook", webhook_secret, WEBHOOK_MAX_CONNECTIONS)
+        resume_broadcast_jobs()
+    
+    threading.Thread(target=boot, name="webhook-boot", daemon=True).start()
+    return webhook_ingest
+
 if __name__ == "__main__":
     print("=" * 60)
     print("🤖 PREMIUM BOT - TWO CHANNELS + DYNAMIC CONFIG")
@@ -1421,15 +1955,20 @@ if __name__ == "__main__":
     print(f"✅ Admin ID: {ADMIN_ID}")
     print(f"✅ Users Loaded: {len(users_data)}")
     print(f"✅ Pending: {len(pending_verifications)}")
-    print(f"✅ Monthly: ₹{PLANS['monthly']['amount']} - Channel: {PLANS['monthly']['channel_id']}")
-    print(f"✅ Lifetime: ₹{PLANS['lifetime']['amount']} - Channel: {PLANS['lifetime']['channel_id']}")
+    plans = current_settings().plans
+    print(f"✅ Monthly: ₹{plans['monthly']['amount']} - Channel: {plans['monthly']['channel_id']}")
+    print(f"✅ Lifetime: ₹{plans['lifetime']['amount']} - Channel: {plans['lifetime']['channel_id']}")
     print("=" * 60)
     print("📋 Type /help for all commands")
     print("📋 Type /settings to view/edit config")
     print("=" * 60)
     
+    if WEBHOOK_URL:
+        print("❌ WEBHOOK_URL is set: start the web app instead (gunicorn -w 1 app:app)")
+        sys.exit(1)
+    
     try:
-        bot.infinity_polling()
+        run_polling()
     except Exception as e:
         print(f"❌ Bot Error: {e}")
         time.sleep(10)
@@ -0,0 +1,299 @@
+import asyncio
+import queue
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# ============ BROADCAST ENGINE ============
+# Sends one message to many users from a pool of worker threads. A shared
+# token bucket keeps the pool under Telegram's global limit (~30 msg/s),
+# 429 responses pause the bucket for `retry_after` and requeue the user,
+# and errors that will never succeed (bot blocked, account deleted, chat
+# not found) are reported separately from transient failures.
+
+SENT = "sent"
+FAILED = "failed"
+UNREACHABLE = "unreachable"
+SKIPPED = "skipped"
+
+PERMANENT_ERRORS = (
+    "bot was blocked by the user",
+    "user is deactivated",
+    "chat not found",
+    "user not found",
+    "bot can't initiate conversation",
+    "bot was kicked",
+    "peer_id_invalid",
+)
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is free"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token and return 0, or return the seconds to wait"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (Telegram's retry_after)"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+
+def classify_error(error):
+    """Return ("retry", seconds), ("permanent", reason) or ("failed", reason)"""
+    code = getattr(error, "error_code", None)
+    description = str(getattr(error, "description", "") or error).lower()
+    if code == 429:
+        parameters = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+        return "retry", parameters.get("retry_after", 1)
+    if code in (400, 403) and any(reason in description for reason in PERMANENT_ERRORS):
+        return "permanent", description
+    if code is None or code >= 500:
+        # Network trouble or a Telegram-side error: worth another try
+        return "retry", 1
+    return "failed", description
+
+
+class BroadcastEngine:
+    """Delivers to a list of user ids with a worker pool and a rate limit.
+    rate=None leaves pacing to `send` (e.g. the outbound scheduler)."""
+
+    def __init__(self, send, rate=25, workers=8, max_attempts=5, skip=None,
+                 on_result=None, on_progress=None, progress_interval=5):
+        self.send = send
+        self.bucket = TokenBucket(rate) if rate else None
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.skip = skip
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.stats = {SENT: 0, FAILED: 0, UNREACHABLE: 0, SKIPPED: 0, "retried": 0}
+        self.stats_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=workers * 50)
+        self.retry_queue = queue.Queue()
+        self.outstanding = 0
+        self.feeding = True
+        self.running = threading.Event()
+        self.running.set()
+        self.cancelled = False
+
+    def pause(self):
+        """Workers stop after their current send until resume()"""
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def cancel(self):
+        """Stop for good; ids not yet sent are left unrecorded"""
+        self.cancelled = True
+        self.running.set()
+
+    def record(self, user_id, outcome, detail=None):
+        with self.stats_lock:
+            self.stats[outcome] += 1
+            self.outstanding -= 1
+        if self.on_result:
+            try:
+                self.on_result(user_id, outcome, detail)
+            except Exception as e:
+                logger.error(f"Broadcast result hook error: {e}")
+
+    def failed(self, user_id, attempt, error):
+        """Record a failed send; returns the (user_id, attempt) to retry, if any"""
+        kind, detail = classify_error(error)
+        if kind == "retry" and attempt + 1 < self.max_attempts:
+            if self.bucket and getattr(error, "error_code", None) == 429:
+                self.bucket.pause(detail)
+            with self.stats_lock:
+                self.stats["retried"] += 1
+            return user_id, attempt + 1
+        if kind == "permanent":
+            self.record(user_id, UNREACHABLE, detail)
+        else:
+            self.record(user_id, FAILED, detail)
+        return None
+
+    def next_item(self):
+        try:
+            return self.retry_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.queue.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    def worker(self):
+        while True:
+            self.running.wait()
+            if self.cancelled:
+                return
+            item = self.next_item()
+            if item is None:
+                if not self.feeding and self.outstanding <= 0:
+                    return
+                continue
+            user_id, attempt = item
+            if self.skip and self.skip(user_id):
+                self.record(user_id, SKIPPED)
+                continue
+            if self.bucket:
+                self.bucket.acquire()
+            try:
+                self.send(user_id)
+                self.record(user_id, SENT)
+            except Exception as e:
+                retry = self.failed(user_id, attempt, e)
+                if retry:
+                    self.retry_queue.put(retry)
+
+    def run(self, user_ids):
+        """Deliver to every id (blocking) and return the stats dict"""
+        threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        last_progress = time.time()
+        for user_id in user_ids:
+            if self.cancelled:
+                break
+            with self.stats_lock:
+                self.outstanding += 1
+            while not self.cancelled:
+                try:
+                    self.queue.put((user_id, 0), timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            if self.on_progress and time.time() - last_progress >= self.progress_interval:
+                last_progress = time.time()
+                self.on_progress(dict(self.stats))
+        self.feeding = False
+        while True:
+            alive = [thread for thread in threads if thread.is_alive()]
+            if not alive:
+                break
+            alive[0].join(self.progress_interval)
+            if self.on_progress:
+                self.on_progress(dict(self.stats))
+        return dict(self.stats)
+
+
+class AsyncBroadcastEngine(BroadcastEngine):
+    """BroadcastEngine on an asyncio loop: `send` is a coroutine function
+    and `workers` is how many sends may be in flight at once. run() can
+    still be called from a plain thread; it blocks until the loop is done."""
+
+    def __init__(self, loop, send, **kwargs):
+        super().__init__(send, **kwargs)
+        self.loop = loop
+
+    def run(self, user_ids):
+        return asyncio.run_coroutine_threadsafe(self.run_async(user_ids), self.loop).result()
+
+    async def run_async(self, user_ids):
+        items = deque((user_id, 0) for user_id in user_ids)
+        self.outstanding = len(items)
+        self.feeding = False
+        tasks = [asyncio.ensure_future(self.async_worker(items)) for _ in range(self.workers)]
+        loop = asyncio.get_running_loop()
+        while not all(task.done() for task in tasks):
+            await asyncio.wait(tasks, timeout=self.progress_interval)
+            if self.on_progress:
+                # Progress hooks make blocking API calls: keep them off the loop
+                await loop.run_in_executor(None, self.on_progress, dict(self.stats))
+        return dict(self.stats)
+
+    async def async_worker(self, items):
+        while not self.cancelled:
+            if not self.running.is_set():
+                await asyncio.sleep(0.2)
+                continue
+            if not items:
+                if self.outstanding <= 0:
+                    return
+                # Others still in flight may requeue a retry
+                await asyncio.sleep(0.05)
+                continue
+            user_id, attempt = items.popleft()
+            if self.skip and self.skip(user_id):
+                self.record(user_id, SKIPPED)
+                continue
+            wait = self.bucket.try_acquire() if self.bucket else 0
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.bucket.try_acquire()
+            try:
+                await self.send(user_id)
+                self.record(user_id, SENT)
+            except Exception as e:
+                retry = self.failed(user_id, attempt, e)
+                if retry:
+                    items.append(retry)
+
+
+class Checkpoint:
+    """Resumable position in a broadcast over sorted user ids.
+
+    Every id <= `cursor` is finished; `done` holds the finished ids above
+    it (workers complete out of order). Persisting the pair costs a few
+    hundred ids at most, however large the audience."""
+
+    def __init__(self, user_ids, cursor=None, done=()):
+        self.cursor = cursor
+        self.order = [uid for uid in user_ids if cursor is None or uid > cursor]
+        self.done = set(done).intersection(self.order)
+        self.pos = 0
+        self.lock = threading.Lock()
+        self.advance()
+
+    def pending(self):
+        """Ids still to deliver, in order"""
+        return [uid for uid in self.order[self.pos:] if uid not in self.done]
+
+    def advance(self):
+        order = self.order
+        while self.pos < len(order) and order[self.pos] in self.done:
+            self.cursor = order[self.pos]
+            self.done.discard(self.cursor)
+            self.pos += 1
+
+    def mark(self, user_id):
+        with self.lock:
+            self.done.add(user_id)
+            self.advance()
+
+    def snapshot(self):
+        """(cursor, sorted done ids) for persisting"""
+        with self.lock:
+            return self.cursor, sorted(self.done)
@@ -1,8 +1,16 @@
-import json
+import atexit
 import os
 import time
-from datetime import datetime, timedelta
 import logging
+import threading
+
+from storage import open_storage, migrate_json_to_sqlite, DirtyTracker, TrackedDict, ShardedDict, WriteScheduler, StripedLocks
+from records import UserRecord
+from segments import Segments
+from settings_view import SettingsSnapshot
+from startup import startup_stage
+
+startup_stage("imports")
 
 # ============ CONFIG FROM ENVIRONMENT ============
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
@@ -23,6 +31,54 @@ SPAM_TIME_WINDOW = int(os.environ.get("SPAM_TIME_WINDOW", "10"))
 WARNING_MESSAGES = ["⚠️ Please don't spam!", "⚠️ This is your last warning!", "⛔ You are being blocked for spamming!"]
 BLOCK_DURATIONS = [300, 900, 1800]  # 5min, 15min, 30min (seconds)
 
+# Outbound API limits shared by every send (Telegram: ~30 msg/s overall,
+# ~1 msg/s per private chat, 20 msg/min per group or channel)
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+
+# Pixels per QR module in payment QR images
+QR_BOX_SIZE = int(os.environ.get("QR_BOX_SIZE", "8"))
+
+# "threads" (TeleBot polling) or "async": asyncio broadcasts and polling over
+# one shared aiohttp session. Handlers run on lane threads in both modes.
+ENGINE = os.environ.get("ENGINE", "threads").lower()
+ASYNC_CONNECTIONS = int(os.environ.get("ASYNC_CONNECTIONS", "100"))
+# Broadcast sends in flight at once under ENGINE=async
+ASYNC_BROADCAST_CONCURRENCY = int(os.environ.get("ASYNC_BROADCAST_CONCURRENCY", "50"))
+
+# Webhook mode (app.py): set WEBHOOK_URL to the app's public base URL to
+# receive updates at <WEBHOOK_URL>/webhook instead of polling. It needs
+# WEBHOOK_SECRET (1-256 of A-Z a-z 0-9 _ -), the token Telegram sends back
+# with every update. Run a single web worker (Procfile: -w 1): lanes,
+# shedding and rate limits live in that one process.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "2"))
+
+# Update processing: worker threads per priority lane (see dispatch.py)
+LANE_WORKERS = {
+    "admin": int(os.environ.get("ADMIN_LANE_WORKERS", "2")),
+    "payment": int(os.environ.get("PAYMENT_LANE_WORKERS", "4")),
+    "general": int(os.environ.get("GENERAL_LANE_WORKERS", "4"))
+}
+
+# Lock stripes guarding in-memory changes to a user's entries (see user_locks below)
+USER_LOCK_STRIPES = int(os.environ.get("USER_LOCK_STRIPES", "64"))
+
+# Load shedding: past these a lane only takes new, non-repeated requests
+SHED_QUEUE_DEPTH = int(os.environ.get("SHED_QUEUE_DEPTH", "200"))
+SHED_WAIT_MS = float(os.environ.get("SHED_WAIT_MS", "3000"))
+SHED_DEDUPE_WINDOW = float(os.environ.get("SHED_DEDUPE_WINDOW", "30"))
+
+# Broadcast throughput: Telegram allows ~30 messages/second overall
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))
+# Seconds between persisted checkpoints of a running broadcast job
+BROADCAST_CHECKPOINT_INTERVAL = float(os.environ.get("BROADCAST_CHECKPOINT_INTERVAL", "5"))
+
 # ============ DATA DIRECTORY ============
 DATA_DIR = "/data"
 if not os.path.exists(DATA_DIR):
@@ -36,6 +92,58 @@ START_MESSAGE_FILE = os.path.join(DATA_DIR, "start_message.json")
 PENDING_VERIF_FILE = os.path.join(DATA_DIR, "pending_verifications.json")
 INVITE_LINKS_FILE = os.path.join(DATA_DIR, "invite_links.json")
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
+INVITE_ARCHIVE_FILE = os.path.join(DATA_DIR, "invite_links_archive.jsonl")
+BROADCAST_JOBS_FILE = os.path.join(DATA_DIR, "broadcast_jobs.json")
+BAN_INDEX_FILE = os.path.join(DATA_DIR, "ban_index.json")
+
+# Background sweeper: how often it runs and how long an expired ban's
+# spam_data entry (and its escalation level) is kept
+SWEEP_INTERVAL = int(os.environ.get("SWEEP_INTERVAL", "3600"))
+SPAM_RETENTION = int(os.environ.get("SPAM_RETENTION", "86400"))
+# How long finished/cancelled broadcast jobs are kept (for /bcstatus)
+BROADCAST_JOB_RETENTION = int(os.environ.get("BROADCAST_JOB_RETENTION", str(7 * 86400)))
+
+# ============ STORAGE BACKEND ============
+# "json" keeps one file per store, "sqlite" writes only the touched rows,
+# "journal" appends per-key changes to a log compacted into snapshots
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").lower()
+STORE_NAMES = ["users_data", "spam_data", "start_message", "pending_verifications", "invite_links", "settings", "broadcast_jobs", "ban_index"]
+
+# Journal appends are cheap, so flush dirty keys every second by default
+AUTOSAVE_INTERVAL = float(os.environ.get("AUTOSAVE_INTERVAL", "1" if STORAGE_BACKEND == "journal" else "30"))
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get("JOURNAL_FSYNC_INTERVAL", "1"))
+JOURNAL_COMPACT_BYTES = int(os.environ.get("JOURNAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+
+# Serialization of persisted state: json (indented), compact, fast (orjson)
+# or msgpack (+zstd). Any format is detected on load, so this can be
+# changed at any time; files keep their .json names.
+STATE_FORMAT = os.environ.get("STATE_FORMAT", "compact").lower()
+
+# JSON backend only: split users_data/spam_data into N shard files under
+# /data/<store>/ (0 = single file). Shards load on demand; at most
+# STATE_MAX_LOADED_SHARDS stay in memory (0 = all).
+STATE_SHARDS = int(os.environ.get("STATE_SHARDS", "0"))
+STATE_MAX_LOADED_SHARDS = int(os.environ.get("STATE_MAX_LOADED_SHARDS", "0")) or None
+SHARDED_STORES = ["users_data", "spam_data"]
+
+storage = open_storage(
+    STORAGE_BACKEND,
+    DATA_DIR,
+    state_format=STATE_FORMAT,
+    shards=STATE_SHARDS,
+    sharded_names=SHARDED_STORES,
+    max_loaded_shards=STATE_MAX_LOADED_SHARDS,
+    fsync_interval=JOURNAL_FSYNC_INTERVAL,
+    compact_bytes=JOURNAL_COMPACT_BYTES
+)
+
+# Handler saves are queued and written by a background thread; repeated
+# saves of the same store within the window become one write
+WRITE_COALESCE_WINDOW = float(os.environ.get("WRITE_COALESCE_WINDOW", "0.5"))
+writer = WriteScheduler(storage, WRITE_COALESCE_WINDOW)
+if STORAGE_BACKEND == "sqlite":
+    migrate_json_to_sqlite(DATA_DIR, storage, STORE_NAMES)
+startup_stage("storage")
 
 # ============ DEFAULT SETTINGS ============
 DEFAULT_SETTINGS = {
@@ -53,40 +161,126 @@ DEFAULT_SETTINGS = {
 }
 
 # ============ DATA LOAD/SAVE FUNCTIONS ============
-def load_json_file(filepath, default=None):
-    """Load JSON file with error handling"""
+def store_name(filepath):
+    """Map a legacy data file path to its store name"""
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+def load_json_file(filepath, default=None, decode=None):
+    """Load a store with error handling; `decode` converts each value"""
     if default is None:
         default = {}
     try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as f:
-                return json.load(f)
-        else:
-            with open(filepath, 'w') as f:
-                json.dump(default, f)
-            return default
+        data = storage.load(store_name(filepath), default)
+        if isinstance(data, ShardedDict):
+            data.decode = decode
+            return data
+        if decode is not None:
+            data = {key: decode(value) for key, value in data.items()}
+        return TrackedDict(data)
     except Exception as e:
         logging.error(f"Error loading {filepath}: {e}")
-        return default
+        return TrackedDict(default)
 
-def save_json_file(filepath, data):
-    """Save JSON file with error handling"""
+def save_json_file(filepath, data, keys=None):
+    """Queue a store for saving; `keys` limits the write to those entries.
+    The write happens in the background, call flush_writes() when the
+    caller must not continue before it is on disk."""
+    # Clear the dirty marks first so changes made during the write are kept;
+    # the writer restores them if the write fails
+    if isinstance(data, DirtyTracker):
+        if keys is None:
+            data.take_dirty()
+        else:
+            # touch() first so sharded stores see the shard as changed
+            data.touch(*keys)
+            data.discard_dirty(keys)
     try:
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=4)
+        writer.submit(store_name(filepath), data, keys)
         return True
     except Exception as e:
         logging.error(f"Error saving {filepath}: {e}")
         return False
 
+def flush_writes(timeout=10):
+    """Wait until every queued save has been written"""
+    return writer.flush(timeout)
+
+# ============ INCREMENTAL AUTOSAVE ============
+persist_metrics = {
+    "flushes": 0,
+    "skipped": 0,
+    "last_keys": 0,
+    "last_bytes": 0,
+    "last_duration_ms": 0.0,
+    "total_bytes": 0
+}
+
+def tracked_stores():
+    """(filepath, dict) for every persisted store"""
+    return [
+        (USERS_DATA_FILE, users_data),
+        # Before spam_data: bans are enforced from the index, so it must
+        # never be the older of the two after a crash
+        (BAN_INDEX_FILE, ban_index),
+        (SPAM_DATA_FILE, spam_data),
+        (START_MESSAGE_FILE, start_message_data),
+        (PENDING_VERIF_FILE, pending_verifications),
+        (INVITE_LINKS_FILE, invite_links),
+        (SETTINGS_FILE, settings),
+        (BROADCAST_JOBS_FILE, broadcast_jobs)
+    ]
+
+def flush_dirty_data():
+    """Persist only the keys changed since the last flush; no-op when clean"""
+    start = time.time()
+    keys_written = 0
+    bytes_written = 0
+    for filepath, data in tracked_stores():
+        if not data.is_dirty():
+            continue
+        all_dirty, dirty = data.take_dirty()
+        try:
+            bytes_written += storage.save(store_name(filepath), data, None if all_dirty else dirty)
+            keys_written += len(data) if all_dirty else len(dirty)
+        except Exception as e:
+            logging.error(f"Error flushing {filepath}: {e}")
+            data.restore_dirty(all_dirty, dirty)
+    
+    if not keys_written:
+        persist_metrics["skipped"] += 1
+        return 0
+    
+    persist_metrics["flushes"] += 1
+    persist_metrics["last_keys"] = keys_written
+    persist_metrics["last_bytes"] = bytes_written
+    persist_metrics["last_duration_ms"] = (time.time() - start) * 1000
+    persist_metrics["total_bytes"] += bytes_written
+    return keys_written
+
 # ============ LOAD ALL DATA ============
-users_data = load_json_file(USERS_DATA_FILE, {})
-spam_data = load_json_file(SPAM_DATA_FILE, {})
-start_message_data = load_json_file(START_MESSAGE_FILE, {})
-pending_verifications = load_json_file(PENDING_VERIF_FILE, {})
+# Sequential on purpose: decoding is GIL-bound, so a thread pool only
+# added overhead; the big stores shard and load lazily instead.
+def load_stores(loads):
+    """Run {name: (filepath, default, decode)} loads"""
+    return {name: load_json_file(*args) for name, args in loads.items()}
+
+_loaded = load_stores({
+    "users_data": (USERS_DATA_FILE, {}, UserRecord.from_dict),
+    "spam_data": (SPAM_DATA_FILE, {}, None),
+    "start_message": (START_MESSAGE_FILE, {}, None),
+    "pending_verifications": (PENDING_VERIF_FILE, {}, None),
+    "invite_links": (INVITE_LINKS_FILE, {}, None),
+    "settings": (SETTINGS_FILE, DEFAULT_SETTINGS, None),
+    "broadcast_jobs": (BROADCAST_JOBS_FILE, {}, None),
+    "ban_index": (BAN_INDEX_FILE, {}, None)
+})
+users_data = _loaded["users_data"]
+spam_data = _loaded["spam_data"]
+start_message_data = _loaded["start_message"]
+pending_verifications = _loaded["pending_verifications"]
 
 # FIXED: Load invite_links and ensure all values are LISTS
-invite_links = load_json_file(INVITE_LINKS_FILE, {})
+invite_links = _loaded["invite_links"]
 for user_id in invite_links:
     if not isinstance(invite_links[user_id], list):
         # If it's not a list, convert to list or create new list
@@ -98,83 +292,122 @@ for user_id in invite_links:
             # Unknown format - create empty list
             invite_links[user_id] = []
 
-settings = load_json_file(SETTINGS_FILE, DEFAULT_SETTINGS)
-
-# Update PLANS with settings
-PLANS = {
-    "monthly": {
-        "name": settings.get("monthly_name", "1 Month Premium"),
-        "amount": settings.get("monthly_amount", "99"),
-        "duration": "30 days",
-        "channel_id": settings.get("monthly_channel_id", "")
-    },
-    "lifetime": {
-        "name": settings.get("lifetime_name", "Lifetime Premium"),
-        "amount": settings.get("lifetime_amount", "149"),
-        "duration": "Lifetime",
-        "channel_id": settings.get("lifetime_channel_id", "")
-    }
-}
+settings = _loaded["settings"]
+# A settings file written before a key existed gets the default for it, so
+# building the snapshot (and settings[...] in handlers) never hits a KeyError
+for key, value in DEFAULT_SETTINGS.items():
+    settings.setdefault(key, value)
+
+# One lock stripe per user id: update workers hold it while handling that
+# user, and saves copy the user's entries under it
+user_locks = StripedLocks(USER_LOCK_STRIPES)
+for user_store in (users_data, spam_data, pending_verifications, invite_links):
+    user_store.key_lock = user_locks.lock_for
+
+broadcast_jobs = _loaded["broadcast_jobs"]
+# Active bans (uid -> blocked_until), maintained by BanRegistry; saved by autosave
+ban_index = _loaded["ban_index"]
+del _loaded
+
+# Broadcast audience index, kept in step by save_users_data()
+segments = Segments(users_data)
+
+# What handlers read: an immutable snapshot, replaced by save_settings()
+_settings_snapshot = SettingsSnapshot(settings)
+_settings_lock = threading.Lock()
+startup_stage("state")
+
+def current_settings():
+    """The current settings snapshot (take it once per handler)"""
+    return _settings_snapshot
 
 # Individual save functions
-def save_users_data():
-    """Save users data"""
-    save_json_file(USERS_DATA_FILE, users_data)
+def save_users_data(*user_ids):
+    """Save users data (only the given users if any) and refresh their segments"""
+    if user_ids:
+        for user_id in user_ids:
+            segments.update(user_id, users_data.get(str(user_id)))
+    else:
+        segments.invalidate()
+    save_json_file(USERS_DATA_FILE, users_data, [str(u) for u in user_ids] or None)
+
+def save_spam_data(*user_ids):
+    """Save spam data (only the given users if any) with their ban index
+    entries, the index first"""
+    keys = [str(u) for u in user_ids] or None
+    save_json_file(BAN_INDEX_FILE, ban_index, keys)
+    save_json_file(SPAM_DATA_FILE, spam_data, keys)
+
+def save_pending_verifications(*user_ids):
+    """Save pending verifications (only the given users if any)"""
+    save_json_file(PENDING_VERIF_FILE, pending_verifications, [str(u) for u in user_ids] or None)
 
-def save_spam_data():
-    """Save spam data"""
-    save_json_file(SPAM_DATA_FILE, spam_data)
+def save_invite_links(*user_ids):
+    """Save invite links (only the given users if any)"""
+    save_json_file(INVITE_LINKS_FILE, invite_links, [str(u) for u in user_ids] or None)
+
+def save_broadcast_jobs(*job_ids):
+    """Save broadcast jobs; pass ids to write only those jobs"""
+    save_json_file(BROADCAST_JOBS_FILE, broadcast_jobs, [str(j) for j in job_ids] or None)
 
 def save_start_message():
     """Save start message"""
     save_json_file(START_MESSAGE_FILE, start_message_data)
 
 def save_settings():
-    """Save settings"""
-    save_json_file(SETTINGS_FILE, settings)
-    # Update PLANS with new settings
-    global PLANS
-    PLANS = {
-        "monthly": {
-            "name": settings.get("monthly_name", "1 Month Premium"),
-            "amount": settings.get("monthly_amount", "99"),
-            "duration": "30 days",
-            "channel_id": settings.get("monthly_channel_id", "")
-        },
-        "lifetime": {
-            "name": settings.get("lifetime_name", "Lifetime Premium"),
-            "amount": settings.get("lifetime_amount", "149"),
-            "duration": "Lifetime",
-            "channel_id": settings.get("lifetime_channel_id", "")
-        }
-    }
+    """Save settings and publish them as the next snapshot version"""
+    global _settings_snapshot
+    with _settings_lock:
+        save_json_file(SETTINGS_FILE, settings)
+        _settings_snapshot = SettingsSnapshot(settings, _settings_snapshot.version + 1)
 
 def save_all_data():
-    """Save all data at once"""
-    save_json_file(USERS_DATA_FILE, users_data)
-    save_json_file(SPAM_DATA_FILE, spam_data)
-    save_json_file(START_MESSAGE_FILE, start_message_data)
-    save_json_file(PENDING_VERIF_FILE, pending_verifications)
-    save_json_file(INVITE_LINKS_FILE, invite_links)
-    save_json_file(SETTINGS_FILE, settings)
+    """Save all data at once and wait for the writes"""
+    for filepath, data in tracked_stores():
+        save_json_file(filepath, data)
+    flush_writes()
     print("💾 All data saved")
 
-# Initialize spam data for existing users
-def initialize_spam_data():
-    """Ensure all existing users have spam_data entries"""
-    initialized = 0
-    for user_id_str in users_data.keys():
-        if user_id_str not in spam_data:
-            spam_data[user_id_str] = {
-                "requests": [],
-                "warnings": 0,
-                "blocked_until": 0,
-                "block_level": 0,
-                "ban_reason": "",
-                "banned_by": 0
-            }
-            initialized += 1
-    if initialized > 0:
-        print(f"✅ Initialized spam data for {initialized} users")
-
-initialize_spam_data()
+def shutdown_storage():
+    """Flush pending changes and close the backend on interpreter exit"""
+    try:
+        flush_writes()
+        flush_dirty_data()
+        storage.close()
+    except Exception as e:
+        logging.error(f"Error closing storage: {e}")
+
+atexit.register(shutdown_storage)
+
+# ============ SPAM DATA ============
+# spam_data only keeps ban state; request counts live in limiter.SpamLimiter
+LEGACY_SPAM_KEYS = ("requests", "warnings")
+
+def new_spam_entry():
+    """Default spam_data entry, created lazily when a user is first blocked"""
+    return {
+        "blocked_until": 0,
+        "block_level": 0,
+        "ban_reason": "",
+        "banned_by": 0
+    }
+
+def prune_empty_spam_data():
+    """Drop spam_data entries that hold no ban state and strip the request
+    lists older versions persisted for every user"""
+    if isinstance(spam_data, ShardedDict):
+        # Would load every shard; the entries are harmless until rewritten
+        return
+    dropped = 0
+    for uid, entry in list(spam_data.items()):
+        if not entry.get("blocked_until") and not entry.get("block_level"):
+            del spam_data[uid]
+            dropped += 1
+        elif any(key in entry for key in LEGACY_SPAM_KEYS):
+            for key in LEGACY_SPAM_KEYS:
+                entry.pop(key, None)
+            spam_data.touch(uid)
+    if dropped:
+        print(f"🧹 Dropped {dropped} empty spam entries")
+
+prune_empty_spam_data()
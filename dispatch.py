@@ -0,0 +1,215 @@
+import queue
+import threading
+import time
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ============ PRIORITY LANES ============
+# Incoming updates are sorted into lanes (admin, payment, general), each
+# with its own queue and worker threads, so a flood of /start messages in
+# the general lane cannot delay the admin's verify buttons or a user's
+# payment screenshot. The bot runs with threaded=False: lane workers call
+# TeleBot.process_new_updates for one update at a time and the handlers run
+# inline on the worker.
+#
+# Within a lane each worker owns a queue and a user's updates always hash
+# to the same one, so they run in order. Nothing is held across lanes:
+# handlers take the user's lock stripe (config.user_locks) only around the
+# in-memory changes to that user's entries, never across network calls.
+
+ADMIN = "admin"
+PAYMENT = "payment"
+GENERAL = "general"
+LANES = (ADMIN, PAYMENT, GENERAL)
+
+
+class AdmissionController:
+    """Sheds low-value updates before any handler runs when a lane is
+    backed up (queue depth or average queue wait past the thresholds).
+
+    While overloaded, a /start or a callback press that repeats one the
+    same user made inside `dedupe_window` seconds is dropped (callbacks are
+    answered through `on_shed` so the button stops spinning), and past
+    `overflow_factor` x max_depth the general lane takes nothing at all.
+    The admin lane is never shed."""
+
+    def __init__(self, max_depth=200, max_wait_ms=3000, dedupe_window=30,
+                 overflow_factor=4, on_shed=None):
+        self.max_depth = max_depth
+        self.max_wait_ms = max_wait_ms
+        self.dedupe_window = dedupe_window
+        self.overflow_factor = overflow_factor
+        self.on_shed = on_shed
+        self.recent = {}
+        self.next_prune = time.monotonic() + dedupe_window
+        self.metrics = {
+            "admitted": 0,
+            "duplicate_start": 0,
+            "repeat_callback": 0,
+            "overflow": 0
+        }
+        # Per lane: when it became overloaded, None while it is not
+        self.overloaded_since = {lane: None for lane in LANES}
+
+    @staticmethod
+    def key_of(update):
+        """(kind, user id, detail) identifying repeats of the same request"""
+        if update.callback_query:
+            call = update.callback_query
+            return "callback", call.from_user.id, call.data
+        message = update.message
+        if message and message.from_user and message.text and message.text.startswith("/start"):
+            return "start", message.from_user.id, None
+        return None
+
+    def overloaded(self, depth, wait_ms):
+        # The wait average only moves when updates are handled: ignore it once the queue is empty
+        return depth >= self.max_depth or (depth > 0 and wait_ms >= self.max_wait_ms)
+
+    def _prune(self, now):
+        self.next_prune = now + self.dedupe_window
+        cutoff = now - self.dedupe_window
+        self.recent = {key: seen for key, seen in self.recent.items() if seen > cutoff}
+
+    def admit(self, update, lane, depth, wait_ms):
+        """True to queue the update, False if it was shed"""
+        now = time.monotonic()
+        if now >= self.next_prune:
+            self._prune(now)
+        key = self.key_of(update)
+        last = self.recent.get(key) if key else None
+        if key:
+            self.recent[key] = now
+        if lane == ADMIN:
+            self.metrics["admitted"] += 1
+            return True
+        if not self.overloaded(depth, wait_ms):
+            self.overloaded_since[lane] = None
+            self.metrics["admitted"] += 1
+            return True
+        if self.overloaded_since[lane] is None:
+            self.overloaded_since[lane] = time.time()
+            logger.warning(f"Shedding load: {lane} lane depth {depth}, avg wait {wait_ms:.0f} ms")
+        if last is not None and now - last < self.dedupe_window:
+            reason = "duplicate_start" if key[0] == "start" else "repeat_callback"
+        elif lane == GENERAL and depth >= self.max_depth * self.overflow_factor:
+            reason = "overflow"
+        else:
+            self.metrics["admitted"] += 1
+            return True
+        self.metrics[reason] += 1
+        if self.on_shed:
+            try:
+                self.on_shed(update, reason)
+            except Exception as e:
+                logger.error(f"Shed hook error: {e}")
+        return False
+
+    def stats(self):
+        return dict(self.metrics, overloaded_since=dict(self.overloaded_since))
+
+
+class LaneDispatcher:
+    """Feeds updates to per-lane worker pools"""
+
+    def __init__(self, bot, classify, workers, admission=None, user_of=None):
+        self.bot = bot
+        self.classify = classify
+        self.workers = workers
+        self.admission = admission
+        self.user_of = user_of
+        self.process = type(bot).process_new_updates.__get__(bot)
+        self.queues = {
+            lane: [queue.Queue() for _ in range(max(1, workers.get(lane, 1)))]
+            for lane in LANES
+        }
+        self.metrics = {
+            lane: {"processed": 0, "errors": 0, "peak": 0, "wait_ms": 0.0, "recent_wait_ms": 0.0}
+            for lane in LANES
+        }
+        self.lock = threading.Lock()
+
+    def install(self):
+        """Take over update processing from the bot and start the workers"""
+        for lane in LANES:
+            for i in range(len(self.queues[lane])):
+                thread = threading.Thread(
+                    target=self.worker, args=(lane, i), name=f"lane-{lane}-{i}", daemon=True
+                )
+                thread.start()
+        self.bot.process_new_updates = self.submit
+
+    def lane_of(self, update):
+        try:
+            return self.classify(update)
+        except Exception as e:
+            logger.error(f"Update classification error: {e}")
+            return GENERAL
+
+    def user_key(self, update):
+        try:
+            return self.user_of(update) if self.user_of else None
+        except Exception as e:
+            logger.error(f"Update user lookup error: {e}")
+            return None
+
+    def depth(self, lane):
+        return sum(q.qsize() for q in self.queues[lane])
+
+    def submit(self, updates):
+        """Replacement for bot.process_new_updates: queue and return"""
+        now = time.monotonic()
+        for update in updates:
+            # Polling asks for offset last_update_id + 1 right after this returns
+            if update.update_id > self.bot.last_update_id:
+                self.bot.last_update_id = update.update_id
+            lane = self.lane_of(update)
+            if self.admission and not self.admission.admit(
+                    update, lane, self.depth(lane), self.metrics[lane]["recent_wait_ms"]):
+                continue
+            user = self.user_key(update)
+            queues = self.queues[lane]
+            index = zlib.crc32(str(user).encode()) % len(queues) if user is not None else 0
+            queues[index].put((now, user, update))
+            depth = self.depth(lane)
+            metrics = self.metrics[lane]
+            if depth > metrics["peak"]:
+                metrics["peak"] = depth
+
+    def worker(self, lane, index):
+        lane_queue = self.queues[lane][index]
+        metrics = self.metrics[lane]
+        while True:
+            queued_at, user, update = lane_queue.get()
+            waited = (time.monotonic() - queued_at) * 1000
+            try:
+                self.process([update])
+            except Exception as e:
+                with self.lock:
+                    metrics["errors"] += 1
+                logger.error(f"Error handling update {update.update_id} in {lane} lane: {e}")
+            with self.lock:
+                metrics["processed"] += 1
+                metrics["wait_ms"] += waited
+                # Moving average of queue wait, the admission latency signal
+                metrics["recent_wait_ms"] += (waited - metrics["recent_wait_ms"]) * 0.1
+
+    def stats(self):
+        """{lane: {depth, peak, processed, errors, avg_wait_ms, recent_wait_ms, workers}}"""
+        result = {}
+        with self.lock:
+            for lane in LANES:
+                metrics = self.metrics[lane]
+                processed = metrics["processed"]
+                result[lane] = {
+                    "depth": self.depth(lane),
+                    "peak": metrics["peak"],
+                    "processed": processed,
+                    "errors": metrics["errors"],
+                    "avg_wait_ms": metrics["wait_ms"] / processed if processed else 0.0,
+                    "recent_wait_ms": metrics["recent_wait_ms"],
+                    "workers": self.workers.get(lane, 1)
+                }
+        return result
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import threading
+import logging
+
+import aiohttp
+from telebot import apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+logger = logging.getLogger(__name__)
+
+# ============ ASYNC ENGINE (ENGINE=async) ============
+# An asyncio broadcast path plus one shared aiohttp session. Update
+# handling is NOT asynchronous: handlers still run on the blocking lane
+# worker threads, exactly as with ENGINE=threads.
+# - polling uses AsyncTeleBot.get_updates and hands updates to the lane
+#   dispatcher, so the existing handlers run unchanged
+# - the handlers' synchronous API calls are routed through the loop via
+#   apihelper.CUSTOM_REQUEST_SENDER: the calling thread still blocks, but
+#   every request shares one pooled session instead of one per thread
+# - broadcasts await AsyncTeleBot calls directly (`api`), keeping
+#   hundreds of sends in flight without a thread each; this is the only
+#   part that runs concurrently on the loop
+# - autosave runs as a task on the loop
+
+
+class _Response:
+    """The parts of requests.Response that apihelper reads"""
+
+    __slots__ = ("status_code", "text", "reason")
+
+    def __init__(self, status_code, text, reason):
+        self.status_code = status_code
+        self.text = text
+        self.reason = reason
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncEngine:
+    """Event loop, shared session and polling for ENGINE=async"""
+
+    def __init__(self, token, dispatcher, connections=100, poll_timeout=20,
+                 autosave=None, autosave_interval=30, on_ready=None):
+        self.token = token
+        self.dispatcher = dispatcher
+        self.connections = connections
+        self.poll_timeout = poll_timeout
+        self.autosave = autosave
+        self.autosave_interval = autosave_interval
+        self.on_ready = on_ready
+        self.api = AsyncTeleBot(token, parse_mode="HTML")
+        self.loop = None
+        self.loop_thread = None
+        self.session = None
+        self.ready = threading.Event()
+
+    # ---------- sync -> async bridge ----------
+    def send_request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """apihelper.CUSTOM_REQUEST_SENDER: run the request on the loop"""
+        if self.loop is None or threading.get_ident() == self.loop_thread:
+            # Before start-up, or a blocking call made on the loop itself
+            # (waiting here would deadlock): use a plain requests session
+            return apihelper._get_req_session().request(
+                method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        future = asyncio.run_coroutine_threadsafe(self.request(method, url, params, files, timeout), self.loop)
+        return future.result()
+
+    async def request(self, method, url, params=None, files=None, timeout=None):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        client_timeout = aiohttp.ClientTimeout(total=(connect or 0) + (read or 0) or None, connect=connect)
+        query = {key: value if isinstance(value, str) else str(value) for key, value in (params or {}).items()}
+        data = None
+        if files:
+            data = aiohttp.FormData()
+            for name, value in files.items():
+                filename = name
+                if isinstance(value, tuple):
+                    filename, value = value[0], value[1]
+                data.add_field(name, value, filename=filename or name)
+        async with self.session.request(method.upper(), url, params=query, data=data,
+                                        timeout=client_timeout) as response:
+            return _Response(response.status, await response.text(), response.reason)
+
+    # ---------- tasks ----------
+    async def poll(self):
+        bot = self.dispatcher.bot
+        backoff = 0.25
+        while True:
+            try:
+                updates = await self.api.get_updates(
+                    offset=bot.last_update_id + 1,
+                    timeout=self.poll_timeout,
+                    request_timeout=self.poll_timeout + 10
+                )
+                if updates:
+                    self.dispatcher.submit(updates)
+                backoff = 0.25
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Polling error: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    async def autosave_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.autosave_interval)
+            try:
+                await loop.run_in_executor(None, self.autosave)
+            except Exception as e:
+                logger.error(f"Auto-save error: {e}")
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        # AsyncTeleBot's own calls use the same session
+        asyncio_helper.session_manager.session = self.session
+        apihelper.CUSTOM_REQUEST_SENDER = self.send_request
+        self.ready.set()
+        tasks = [asyncio.ensure_future(self.poll())]
+        if self.autosave:
+            tasks.append(asyncio.ensure_future(self.autosave_loop()))
+        if self.on_ready:
+            self.loop.run_in_executor(None, self.on_ready)
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            apihelper.CUSTOM_REQUEST_SENDER = None
+            self.ready.clear()
+            await self.session.close()
+
+    def run(self):
+        """Block running the engine (the async counterpart of infinity_polling)"""
+        logger.info(f"Async engine: polling with up to {self.connections} connections")
+        asyncio.run(self.main())
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine's loop from any thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
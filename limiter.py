@@ -0,0 +1,84 @@
+import time
+from array import array
+
+# ============ SPAM RATE LIMITER ============
+# Request timestamps live here, in memory, instead of in spam_data. Each
+# active user gets a fixed ring of MAX_SPAM_COUNT slots that is overwritten
+# in place, so a check is O(MAX_SPAM_COUNT) with no list rebuilding. Rings
+# of users idle for longer than the window are dropped periodically.
+
+
+class _Ring:
+    __slots__ = ("stamps", "pos", "warnings", "last")
+
+    def __init__(self, size):
+        self.stamps = array('d', bytes(8 * size))
+        self.pos = 0
+        self.warnings = 0
+        self.last = 0.0
+
+
+class SpamLimiter:
+    """Counts each user's requests inside a sliding time window"""
+
+    def __init__(self, max_count, window, sweep_every=60):
+        self.size = max(1, max_count)
+        self.window = window
+        self.sweep_every = sweep_every
+        self.rings = {}
+        self.next_sweep = time.time() + sweep_every
+
+    def hit(self, user_id, now=None):
+        """Record a request and return how many fall inside the window
+        (including this one)"""
+        if now is None:
+            now = time.time()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        ring = self.rings.get(user_id)
+        if ring is None:
+            ring = self.rings[user_id] = _Ring(self.size)
+        stamps = ring.stamps
+        stamps[ring.pos] = now
+        ring.pos = (ring.pos + 1) % self.size
+        ring.last = now
+        count = 0
+        for ts in stamps:
+            if ts and now - ts < self.window:
+                count += 1
+        return count
+
+    def raise_warning(self, user_id, level):
+        """Raise the user's warning level; True if it went up (send a warning)"""
+        ring = self.rings.get(user_id)
+        if ring is None or ring.warnings >= level:
+            return False
+        ring.warnings = level
+        return True
+
+    def reset(self, user_id):
+        """Forget recent requests and warnings (in place, the ring is reused)"""
+        ring = self.rings.get(user_id)
+        if ring is None:
+            return
+        stamps = ring.stamps
+        for i in range(self.size):
+            stamps[i] = 0.0
+        ring.warnings = 0
+
+    def sweep(self, now=None):
+        """Drop rings with no request inside the window"""
+        if now is None:
+            now = time.time()
+        self.next_sweep = now + self.sweep_every
+        idle = [uid for uid, ring in list(self.rings.items()) if now - ring.last >= self.window]
+        for uid in idle:
+            self.rings.pop(uid, None)
+        return len(idle)
+
+    def __contains__(self, user_id):
+        """True if the user has a live request window"""
+        return user_id in self.rings
+
+    def __len__(self):
+        return len(self.rings)
@@ -0,0 +1,285 @@
+import inspect
+import itertools
+import queue
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ============ OUTBOUND SCHEDULER ============
+# Every message-producing TeleBot call (send_*, copy_*, forward_*,
+# edit_message_*) passes through one scheduler. It enforces a global rate
+# and a per-chat rate, and when calls have to queue it lets user-facing
+# replies go before log-channel traffic, and both before broadcasts.
+# A 429 pauses everything for `retry_after`; the call is then retried
+# (broadcasts re-raise instead, the broadcast engine requeues them).
+#
+# Fire-and-forget posts get one queue and poster thread per destination
+# chat, so an admin alert never waits behind log-channel posts that are
+# crawling through the channel's 20 msg/min bucket.
+
+REPLY = 0
+LOG = 1
+BROADCAST = 2
+
+PRIORITY_NAMES = {REPLY: "reply", LOG: "log", BROADCAST: "broadcast"}
+SCHEDULED_PREFIXES = ("send_", "copy_", "forward_", "edit_message_")
+
+
+def retry_after(error):
+    """Seconds Telegram asked us to wait, or None if not a 429"""
+    if getattr(error, "error_code", None) != 429:
+        return None
+    parameters = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+    return parameters.get("retry_after", 1)
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now):
+        """0 if a token is free now, else seconds until one is"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class OutboundScheduler:
+    """Rate limits and prioritizes a TeleBot instance's outgoing calls"""
+
+    def __init__(self, rate=30, chat_rate=1.0, group_rate=20 / 60, chat_burst=3,
+                 max_retries=3, log_chats=None, post_queue_size=1000):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.log_chats = log_chats
+        self.cond = threading.Condition()
+        self.bucket = _Bucket(rate, rate, time.monotonic())
+        self.chats = {}
+        self.paused_until = 0.0
+        self.waiting = []
+        self.seq = itertools.count()
+        self.local = threading.local()
+        self.post_queue_size = post_queue_size
+        self.posters = {}
+        self.signatures = {}
+        self.next_prune = time.monotonic() + 60
+        self.metrics = {
+            "calls": 0,
+            "queued": 0,
+            "wait_ms": 0.0,
+            "rate_limited": 0,
+            "posted": 0,
+            "dropped": 0,
+            "skipped": 0
+        }
+
+    # ---------- admission ----------
+    def _chat_bucket(self, chat_key, now):
+        bucket = self.chats.get(chat_key)
+        if bucket is None:
+            # Private chats have positive ids; groups/channels are negative or @names
+            rate = self.chat_rate if chat_key.isdigit() else self.group_rate
+            bucket = self.chats[chat_key] = _Bucket(rate, self.chat_burst, now)
+        return bucket
+
+    def _prune(self, now):
+        """Forget chats whose bucket has been full for a while"""
+        self.next_prune = now + 60
+        idle = [key for key, bucket in self.chats.items() if now - bucket.updated > 60]
+        for key in idle:
+            del self.chats[key]
+
+    def _wait_time(self, ticket, now):
+        if now < self.paused_until:
+            return self.paused_until - now
+        chat_wait = self._chat_bucket(ticket[2], now).wait_time(now) if ticket[2] else 0
+        if chat_wait:
+            return chat_wait
+        # A more urgent call that could go now gets the next token
+        for other in self.waiting:
+            if other is not ticket and other[:2] < ticket[:2]:
+                if not other[2] or not self._chat_bucket(other[2], now).wait_time(now):
+                    return 1 / self.rate
+        return self.bucket.wait_time(now)
+
+    def acquire(self, chat_id=None, priority=REPLY):
+        """Block until a call to `chat_id` may be made"""
+        chat_key = str(chat_id) if chat_id is not None else None
+        ticket = (priority, next(self.seq), chat_key)
+        start = time.monotonic()
+        with self.cond:
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._wait_time(ticket, now)
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+            self._take(chat_key, now, now - start)
+
+    def try_acquire(self, chat_id=None, priority=REPLY):
+        """Non-blocking acquire for asyncio callers: take the slot and
+        return 0, or return the seconds to wait before trying again"""
+        chat_key = str(chat_id) if chat_id is not None else None
+        ticket = (priority, next(self.seq), chat_key)
+        with self.cond:
+            now = time.monotonic()
+            wait = self._wait_time(ticket, now)
+            if wait > 0:
+                return wait
+            self._take(chat_key, now, 0)
+            return 0
+
+    def _take(self, chat_key, now, waited):
+        self.bucket.tokens -= 1
+        if chat_key:
+            self.chats[chat_key].tokens -= 1
+        if now >= self.next_prune:
+            self._prune(now)
+        self.metrics["calls"] += 1
+        if waited > 0.001:
+            self.metrics["queued"] += 1
+            self.metrics["wait_ms"] += waited * 1000
+        self.cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold every call for `seconds` (Telegram's retry_after)"""
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.metrics["rate_limited"] += 1
+            self.cond.notify_all()
+
+    # ---------- priorities ----------
+    @contextmanager
+    def priority(self, level):
+        """Run the block's outgoing calls at `level` (e.g. BROADCAST)"""
+        previous = getattr(self.local, "priority", None)
+        self.local.priority = level
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def priority_for(self, chat_id):
+        level = getattr(self.local, "priority", None)
+        if level is not None:
+            return level
+        if self.log_chats and chat_id is not None and str(chat_id) in self.log_chats():
+            return LOG
+        return REPLY
+
+    # ---------- calls ----------
+    def chat_of(self, method, args, kwargs):
+        signature = self.signatures.get(method.__name__)
+        if signature is None:
+            signature = self.signatures[method.__name__] = inspect.signature(method)
+        try:
+            return signature.bind_partial(*args, **kwargs).arguments.get("chat_id")
+        except TypeError:
+            return None
+
+    def call(self, method, *args, **kwargs):
+        """Make a scheduled call; blocks while it waits for its turn"""
+        chat_id = self.chat_of(method, args, kwargs)
+        priority = self.priority_for(chat_id)
+        retries = 0 if priority == BROADCAST else self.max_retries
+        attempt = 0
+        while True:
+            self.acquire(chat_id, priority)
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                seconds = retry_after(e)
+                if seconds is None:
+                    raise
+                self.pause(seconds)
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.warning(f"429 on {method.__name__}, retrying in {seconds}s")
+
+    def offer(self, method, *args, **kwargs):
+        """Make the call only if it can go right now, else drop it (None).
+        For replies to a chat that is flooding us, so the worker handling
+        it never sleeps on that chat's budget."""
+        chat_id = self.chat_of(method, args, kwargs)
+        if self.try_acquire(chat_id, self.priority_for(chat_id)):
+            self.metrics["skipped"] += 1
+            return None
+        try:
+            # The slot is taken: call past the scheduler's wrapper
+            return getattr(method, "__wrapped__", method)(*args, **kwargs)
+        except Exception as e:
+            seconds = retry_after(e)
+            if seconds is not None:
+                self.pause(seconds)
+            raise
+
+    def post(self, method, *args, **kwargs):
+        """Fire-and-forget call, queued behind earlier posts to the same
+        chat only. It runs at the chat's usual priority (LOG for log chats)."""
+        destination = self.chat_of(method, args, kwargs)
+        key = str(destination) if destination is not None else None
+        posts = self.posters.get(key)
+        if posts is None:
+            with self.cond:
+                posts = self.posters.get(key)
+                if posts is None:
+                    posts = self.posters[key] = queue.Queue(maxsize=self.post_queue_size)
+                    threading.Thread(target=self._post_loop, args=(posts,), daemon=True,
+                                     name=f"post-{key or 'direct'}").start()
+        try:
+            posts.put_nowait((method, args, kwargs))
+        except queue.Full:
+            self.metrics["dropped"] += 1
+            logger.error(f"Outbound queue for {key or 'direct calls'} full, dropped {method.__name__}")
+
+    def _post_loop(self, posts):
+        while True:
+            method, args, kwargs = posts.get()
+            try:
+                method(*args, **kwargs)
+                self.metrics["posted"] += 1
+            except Exception as e:
+                logger.error(f"Outbound {method.__name__} error: {e}")
+
+    def install(self, bot):
+        """Route the bot's message-producing methods through the scheduler"""
+        for name in dir(type(bot)):
+            if not name.startswith(SCHEDULED_PREFIXES):
+                continue
+            method = getattr(bot, name)
+            if callable(method):
+                setattr(bot, name, self.wrap(method))
+        return bot
+
+    def wrap(self, method):
+        def scheduled(*args, **kwargs):
+            return self.call(method, *args, **kwargs)
+        scheduled.__name__ = method.__name__
+        scheduled.__wrapped__ = method
+        return scheduled
+
+    def stats(self):
+        with self.cond:
+            waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+            for ticket in self.waiting:
+                waiting[PRIORITY_NAMES[ticket[0]]] += 1
+            backlog = sum(posts.qsize() for posts in self.posters.values())
+        return dict(self.metrics, waiting=waiting, backlog=backlog)
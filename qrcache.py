@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+# ============ QR CACHE ============
+# A payment QR only depends on (upi_id, amount, upi_name), which change only
+# when the admin runs /set. Each rendered PNG is kept under those inputs,
+# and once Telegram has stored it the returned file_id is sent instead, so
+# a plan click costs no image work and no upload. A settings change means a
+# new key; clear() drops the entries for the old values.
+#
+# warm() does the rendering and the first upload ahead of time (at boot and
+# after /set), so the request path only ever sends a file_id.
+
+
+def qr_key(upi_id, amount, name):
+    return str(upi_id), str(amount), str(name)
+
+
+class _Entry:
+    __slots__ = ("png", "file_id")
+
+    def __init__(self, png):
+        self.png = png
+        self.file_id = None
+
+
+class QRCache:
+    """Rendered QR PNGs and their Telegram file_ids"""
+
+    def __init__(self, render, max_entries=16):
+        self.render = render
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {"renders": 0, "uploads": 0, "file_id_hits": 0}
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            png = self.render(*key)
+            if png is None:
+                return None
+            self.metrics["renders"] += 1
+            entry = self.entries[key] = _Entry(png)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return entry
+
+    def png(self, upi_id, amount, name):
+        """PNG bytes of the QR, rendered on first use (None if rendering failed)"""
+        with self.lock:
+            entry = self._entry(qr_key(upi_id, amount, name))
+            return entry.png if entry else None
+
+    def photo(self, upi_id, amount, name):
+        """What to pass as send_photo's `photo`: the file_id once known,
+        otherwise the PNG to upload (None if rendering failed)"""
+        with self.lock:
+            entry = self._entry(qr_key(upi_id, amount, name))
+            if entry is None:
+                return None
+            if entry.file_id:
+                self.metrics["file_id_hits"] += 1
+                return entry.file_id
+            self.metrics["uploads"] += 1
+            return BytesIO(entry.png)
+
+    def remember(self, upi_id, amount, name, message):
+        """Keep the file_id of the photo in `message` (what send_photo returned)"""
+        photos = getattr(message, "photo", None)
+        if not photos:
+            return
+        with self.lock:
+            entry = self.entries.get(qr_key(upi_id, amount, name))
+            if entry is not None:
+                entry.file_id = photos[-1].file_id
+
+    def warm(self, upi_id, amount, name, upload=None):
+        """Render the QR now and, with `upload(photo)` returning the sent
+        message, store its file_id. True once a file_id is known."""
+        key = qr_key(upi_id, amount, name)
+        with self.lock:
+            entry = self._entry(key)
+            if entry is None:
+                return False
+            if entry.file_id or upload is None:
+                return bool(entry.file_id)
+            png = entry.png
+            self.metrics["uploads"] += 1
+        message = upload(BytesIO(png))
+        self.remember(upi_id, amount, name, message)
+        return self.entries.get(key) is entry and bool(entry.file_id)
+
+    def forget_file_id(self, upi_id, amount, name):
+        """Telegram refused the file_id: upload the PNG again next time"""
+        with self.lock:
+            entry = self.entries.get(qr_key(upi_id, amount, name))
+            if entry is not None:
+                entry.file_id = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, entries=len(self.entries))
@@ -0,0 +1,130 @@
+import time
+from datetime import datetime
+
+# ============ COMPACT USER RECORDS ============
+# users_data holds one UserRecord per user instead of a dict. Records use
+# __slots__ and keep start_time as an epoch int, but still behave like the
+# old dicts (record['username'], record.get('is_premium'), ...) so handlers
+# don't need to change. Keys outside the fixed fields go to `extra`.
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_time(value):
+    """Epoch seconds from an int/float or a 'YYYY-MM-DD HH:MM:SS' string"""
+    if value is None or value == "":
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return 0
+
+
+def format_time(ts):
+    return datetime.fromtimestamp(ts).strftime(TIME_FORMAT) if ts else ""
+
+
+class UserRecord:
+    """Slots-based user entry with a dict-like interface"""
+
+    __slots__ = (
+        "id", "username", "first_name", "last_name", "start_ts",
+        "is_premium", "premium_plan", "premium_until", "invite_link",
+        "inactive_since", "payment_initiated", "extra"
+    )
+
+    FIELDS = ("id", "username", "first_name", "last_name", "is_premium",
+              "premium_plan", "premium_until", "invite_link", "inactive_since",
+              "payment_initiated")
+
+    def __init__(self, id=None, username=None, first_name=None, last_name="",
+                 start_time=None, is_premium=False, **extra):
+        self.id = id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.start_ts = parse_time(start_time) if start_time is not None else int(time.time())
+        self.is_premium = is_premium
+        self.premium_plan = None
+        self.premium_until = None
+        self.invite_link = None
+        # Epoch time a broadcast found the chat dead (blocked/deleted), else None
+        self.inactive_since = None
+        # Epoch time the user last picked a plan, else None
+        self.payment_initiated = None
+        self.extra = None
+        for key, value in extra.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        record = cls(start_time=data.get('start_time', 0))
+        for key, value in data.items():
+            if key != 'start_time':
+                record[key] = value
+        return record
+
+    def to_dict(self):
+        data = {'start_time': self.start_ts}
+        for key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not None or key in ('username', 'first_name'):
+                data[key] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    # ---------- mapping façade ----------
+    def __getitem__(self, key):
+        if key == 'start_time':
+            return format_time(self.start_ts)
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None and key not in ('username', 'first_name'):
+                raise KeyError(key)
+            return value
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'start_time':
+            self.start_ts = parse_time(value)
+        elif key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        data = self.to_dict()
+        data['start_time'] = format_time(self.start_ts)
+        return data.items()
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()!r})"
@@ -0,0 +1,185 @@
+import bisect
+import threading
+import logging
+from array import array
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# ============ AUDIENCE SEGMENTS ============
+# Broadcast audiences as precomputed bitsets. Every user gets a dense slot
+# number; each segment is a bytearray with one bit per slot, and join times
+# are kept as a sorted (start_ts, slot) list. Memberships are updated one
+# user at a time whenever the user is saved, so picking an audience is a
+# few big-int ANDs instead of a scan over users_data. Users marked
+# inactive (unreachable) are in no segment.
+
+SEGMENTS = ("all", "premium", "free", "monthly", "lifetime", "unverified")
+
+
+def classify(user):
+    """Segment names a user belongs to"""
+    if user is None or user.inactive_since:
+        return ()
+    names = ["all"]
+    if user.is_premium:
+        names.append("premium")
+        if user.premium_plan in ("monthly", "lifetime"):
+            names.append(user.premium_plan)
+    else:
+        names.append("free")
+        if user.payment_initiated:
+            # Picked a plan but was never verified
+            names.append("unverified")
+    return names
+
+
+def parse_day(value):
+    return int(datetime.strptime(value, "%Y-%m-%d").timestamp())
+
+
+class Segments:
+    """Segment bitsets over users_data, built on first use"""
+
+    def __init__(self, users):
+        self.users = users
+        self.lock = threading.Lock()
+        self.built = False
+
+    def build(self):
+        self.slots = {}
+        self.ids = array('q')
+        self.starts = array('q')
+        self.bits = {name: bytearray(64) for name in SEGMENTS}
+        self.joined = []
+        # A sharded users_data is read shard by shard without loading it all
+        scan = getattr(self.users, "scan_items", self.users.items)
+        skipped = 0
+        for uid, user in scan():
+            if not str(uid).isdigit():
+                # Not a Telegram user id (e.g. a bad /impdata key)
+                skipped += 1
+                continue
+            self._set(uid, user, bulk=True)
+        if skipped:
+            logger.warning(f"Segments: skipped {skipped} non-numeric user ids")
+        self.joined.sort()
+        self.built = True
+
+    def _ensure(self):
+        if not self.built:
+            self.build()
+
+    def _slot(self, uid):
+        slot = self.slots.get(uid)
+        if slot is None:
+            slot = self.slots[uid] = len(self.ids)
+            self.ids.append(int(uid))
+            self.starts.append(-1)
+            size = slot // 8 + 1
+            for bits in self.bits.values():
+                if len(bits) < size:
+                    bits.extend(bytes(len(bits)))
+        return slot
+
+    def _set(self, uid, user, bulk=False):
+        slot = self._slot(uid)
+        names = classify(user)
+        byte, mask = slot >> 3, 1 << (slot & 7)
+        for name, bits in self.bits.items():
+            if name in names:
+                bits[byte] |= mask
+            else:
+                bits[byte] &= ~mask
+        # Only active users sit in the join-time index
+        start = user.start_ts if names else -1
+        old = self.starts[slot]
+        if old != start:
+            if old >= 0:
+                i = bisect.bisect_left(self.joined, (old, slot))
+                if i < len(self.joined) and self.joined[i] == (old, slot):
+                    del self.joined[i]
+            if start >= 0 and bulk:
+                # build() sorts once at the end
+                self.joined.append((start, slot))
+            elif start >= 0:
+                bisect.insort(self.joined, (start, slot))
+            self.starts[slot] = start
+
+    def update(self, uid, user=None):
+        """Refresh one user's memberships (None: the user was removed)"""
+        uid = str(uid)
+        if not uid.isdigit():
+            return
+        with self.lock:
+            if self.built:
+                self._set(uid, user)
+
+    def invalidate(self):
+        """Rebuild from users_data on next use (after bulk changes)"""
+        with self.lock:
+            self.built = False
+
+    # ---------- queries (bitsets as ints) ----------
+    def segment(self, name):
+        return int.from_bytes(self.bits[name], "little")
+
+    def joined_between(self, start=None, end=None):
+        """Bitset of users who joined in [start, end)"""
+        lo = 0 if start is None else bisect.bisect_left(self.joined, (start, -1))
+        hi = len(self.joined) if end is None else bisect.bisect_left(self.joined, (end, -1))
+        result = bytearray(len(self.bits["all"]))
+        for _, slot in self.joined[lo:hi]:
+            result[slot >> 3] |= 1 << (slot & 7)
+        return int.from_bytes(result, "little")
+
+    def joined_count(self, start=None, end=None):
+        """How many active users joined in [start, end)"""
+        with self.lock:
+            self._ensure()
+            lo = 0 if start is None else bisect.bisect_left(self.joined, (start, -1))
+            hi = len(self.joined) if end is None else bisect.bisect_left(self.joined, (end, -1))
+            return hi - lo
+
+    def term(self, term):
+        """Bitset for one query term: a segment name or joined:FROM..TO"""
+        if term in self.bits:
+            return self.segment(term)
+        if term.startswith("joined:") and ".." in term:
+            start, end = term[len("joined:"):].split("..", 1)
+            return self.joined_between(
+                parse_day(start) if start else None,
+                # TO is inclusive: up to the end of that day
+                parse_day(end) + 86400 if end else None
+            )
+        raise ValueError(f"Unknown segment: {term}")
+
+    def ids_of(self, bitset):
+        """Sorted user ids of a bitset"""
+        ids = self.ids
+        result = []
+        data = bitset.to_bytes((bitset.bit_length() + 7) // 8, "little")
+        for byte_index, byte in enumerate(data):
+            if byte:
+                base = byte_index << 3
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        result.append(ids[base + bit])
+        result.sort()
+        return result
+
+    def select(self, query="all", joined_before=None):
+        """Sorted ids matching every term of `query` (space-separated)"""
+        with self.lock:
+            self._ensure()
+            bitset = self.segment("all")
+            for term in query.split():
+                bitset &= self.term(term)
+            if joined_before is not None:
+                bitset &= self.joined_between(None, joined_before + 1)
+            return self.ids_of(bitset)
+
+    def counts(self):
+        with self.lock:
+            self._ensure()
+            return {name: bin(self.segment(name)).count("1") for name in SEGMENTS}
@@ -0,0 +1,189 @@
+from types import MappingProxyType
+
+from telebot import types
+
+# ============ SETTINGS SNAPSHOT ============
+# Handlers read settings through an immutable SettingsSnapshot instead of
+# the mutable settings dict. save_settings() builds a new snapshot (with the
+# next version number) and swaps it in with one assignment, so a handler
+# that took a snapshot sees one consistent set of values without locking,
+# even while /set runs. Everything that only depends on settings (plans,
+# keyboards as serialized JSON, static message bodies) is built once per
+# version here; handlers only fill in per-user fields.
+
+PLAN_TYPES = ("monthly", "lifetime")
+
+
+def build_plans(values):
+    return {
+        "monthly": {
+            "name": values.get("monthly_name", "1 Month Premium"),
+            "amount": values.get("monthly_amount", "99"),
+            "duration": "30 days",
+            "channel_id": values.get("monthly_channel_id", "")
+        },
+        "lifetime": {
+            "name": values.get("lifetime_name", "Lifetime Premium"),
+            "amount": values.get("lifetime_amount", "149"),
+            "duration": "Lifetime",
+            "channel_id": values.get("lifetime_channel_id", "")
+        }
+    }
+
+
+# ---------- keyboards ----------
+def plan_selection_keyboard(values, plans):
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    btn1 = types.InlineKeyboardButton(
+        f"📅 {plans['monthly']['name']} - ₹{plans['monthly']['amount']}",
+        callback_data="plan_monthly"
+    )
+    btn2 = types.InlineKeyboardButton(
+        f"♾️ {plans['lifetime']['name']} - ₹{plans['lifetime']['amount']}",
+        callback_data="plan_lifetime"
+    )
+    btn3 = types.InlineKeyboardButton("❓ How To Get", callback_data="how_to_get")
+    btn4 = types.InlineKeyboardButton("📞 Support", url=f"https://t.me/{values['support_username']}")
+    keyboard.add(btn1, btn2)
+    keyboard.add(btn3, btn4)
+    return keyboard
+
+
+def main_menu_keyboard(values):
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    btn1 = types.InlineKeyboardButton("📢 Premium Demo", url=values['demo_channel_link'])
+    btn2 = types.InlineKeyboardButton("💰 Get Premium", callback_data="get_premium")
+    btn3 = types.InlineKeyboardButton("❓ How To Get", callback_data="how_to_get")
+    keyboard.add(btn1, btn2, btn3)
+    return keyboard
+
+
+def payment_keyboard(values):
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    btn1 = types.InlineKeyboardButton("✅ Payment Done", callback_data="payment_done")
+    btn2 = types.InlineKeyboardButton("📞 Support", url=f"https://t.me/{values['support_username']}")
+    keyboard.add(btn1, btn2)
+    return keyboard
+
+
+# ---------- message bodies ----------
+def welcome_text(plans):
+    return f"""
+<b>🔥 PREMIUM CONTENT 🔥</b>
+
+<b>Membership Plans:</b>
+📅 {plans['monthly']['name']} - ₹{plans['monthly']['amount']}
+♾️ {plans['lifetime']['name']} - ₹{plans['lifetime']['amount']}
+
+<b>Features:</b>
+• 55k+ Premium Videos
+• Lifetime Access (Lifetime plan)
+• Fast Support
+• Daily Updates
+
+<b>👇 Choose your plan:</b>
+    """
+
+
+def how_to_get_text(values):
+    return f"""
+<b>❓ HOW TO GET PREMIUM:</b>
+
+1. Click "Get Premium" button
+2. Choose your plan (Monthly/Lifetime)
+3. Scan QR code and pay exact amount
+4. Click "Payment Done" button
+5. Send payment screenshot
+6. Admin verifies within few minutes
+7. Get unique join link after verification
+
+<b>Support:</b> @{values['support_username']}
+    """
+
+
+def payment_caption(values, plan):
+    return f"""
+<b>💰 PAY ₹{plan['amount']} FOR {plan['name'].upper()}</b>
+
+<b>UPI Details:</b>
+└ ID: <code>{values['upi_id']}</code>
+└ Name: {values['upi_name']}
+└ Amount: <b>₹{plan['amount']}</b>
+
+<b>Instructions:</b>
+1. Scan QR with any UPI app
+2. Pay ₹{plan['amount']}
+3. Click "✅ Payment Done" below
+    """
+
+
+def payment_manual_text(values, plan):
+    return f"""
+<b>💰 PAY ₹{plan['amount']} FOR {plan['name'].upper()}</b>
+
+<b>UPI ID:</b> <code>{values['upi_id']}</code>
+<b>Amount:</b> ₹{plan['amount']}
+
+<b>Steps:</b>
+1. Send ₹{plan['amount']} to above UPI ID
+2. Click "✅ Payment Done" below
+        """
+
+
+def screenshot_request_text(values, plan):
+    return f"""
+<b>📸 SEND PAYMENT SCREENSHOT</b>
+
+<b>Plan Selected:</b> {plan['name']}
+<b>Amount to Pay:</b> ₹{plan['amount']}
+<b>UPI ID:</b> <code>{values['upi_id']}</code>
+
+✅ <b>Payment Done!</b>
+
+Now please send the <b>payment screenshot</b> for verification.
+
+<b>Instructions:</b>
+1. Take screenshot of UPI payment
+2. Send it here as photo
+3. Admin will verify within few minutes
+4. You'll receive unique join link after verification
+
+⏳ <i>Please wait for admin verification...</i>
+            """
+
+
+class SettingsSnapshot:
+    """One version of the settings and everything derived from them.
+    Read-only: build a new snapshot to change anything."""
+
+    __slots__ = ("version", "values", "plans", "keyboards", "texts")
+
+    def __init__(self, values, version=1):
+        values = dict(values)
+        plans = build_plans(values)
+        self.version = version
+        self.values = MappingProxyType(values)
+        self.plans = MappingProxyType({name: MappingProxyType(plan) for name, plan in plans.items()})
+        # Serialized once: TeleBot sends a str reply_markup as-is
+        self.keyboards = MappingProxyType({
+            "main_menu": main_menu_keyboard(values).to_json(),
+            "plan_selection": plan_selection_keyboard(values, plans).to_json(),
+            "payment": payment_keyboard(values).to_json()
+        })
+        texts = {
+            "welcome": welcome_text(plans),
+            "how_to_get": how_to_get_text(values),
+            "choose_plan": "👇 <b>Choose your membership plan:</b>"
+        }
+        for plan_type in PLAN_TYPES:
+            plan = plans[plan_type]
+            texts[f"payment_caption:{plan_type}"] = payment_caption(values, plan)
+            texts[f"payment_manual:{plan_type}"] = payment_manual_text(values, plan)
+            texts[f"screenshot_request:{plan_type}"] = screenshot_request_text(values, plan)
+        self.texts = MappingProxyType(texts)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
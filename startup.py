@@ -0,0 +1,21 @@
+import time
+
+# ============ STARTUP TIMING ============
+# Milliseconds per startup stage, from the first import of this module
+# (the top of bot.py) until the bot is set up. Each startup_stage() call
+# closes the stage that started at the previous call.
+
+startup_timings = {}
+_startup_began = _startup_last = time.perf_counter()
+
+
+def startup_stage(name):
+    """Record the time since the previous stage as stage `name`"""
+    global _startup_last
+    now = time.perf_counter()
+    startup_timings[name] = (now - _startup_last) * 1000
+    _startup_last = now
+
+
+def startup_total_ms():
+    return (time.perf_counter() - _startup_began) * 1000
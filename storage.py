@@ -0,0 +1,942 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import logging
+from collections.abc import MutableMapping
+
+# Optional faster / denser serializers
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# ============ SERIALIZATION ============
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+JSON_START = b'{["-0123456789tfn'
+
+
+def to_plain(obj):
+    """Serializer fallback for in-memory record types (see records.py)"""
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def json_dumps(obj):
+    """Compact JSON as bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=to_plain)
+    return json.dumps(obj, separators=(",", ":"), default=to_plain).encode()
+
+
+def json_loads(payload):
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+class Serializer:
+    """Encodes persisted state in the configured format.
+
+    Formats: "json" (indented, the original layout), "compact" (no
+    whitespace), "fast" (compact via orjson when installed) and "msgpack"
+    (zstd-compressed when zstandard is installed). Loading detects the
+    format from the payload itself, so files written in any format keep
+    working after the setting changes.
+    """
+
+    FORMATS = ("json", "compact", "fast", "msgpack")
+
+    def __init__(self, fmt="compact"):
+        if fmt not in self.FORMATS:
+            logger.warning(f"Unknown state format {fmt!r}, using compact JSON")
+            fmt = "compact"
+        if fmt == "msgpack" and msgpack is None:
+            logger.warning("msgpack is not installed, using compact JSON")
+            fmt = "compact"
+        self.format = fmt
+        self.compressor = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+
+    def dumps(self, obj):
+        if self.format == "json":
+            return json.dumps(obj, indent=4, default=to_plain).encode()
+        if self.format == "compact":
+            return json.dumps(obj, separators=(",", ":"), default=to_plain).encode()
+        if self.format == "fast":
+            return json_dumps(obj)
+        payload = msgpack.packb(obj, use_bin_type=True, default=to_plain)
+        if self.compressor is not None:
+            payload = self.compressor.compress(payload)
+        return payload
+
+    def loads(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if payload.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise ValueError("zstd-compressed state but zstandard is not installed")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        head = payload.lstrip()[:1]
+        if not head or head in JSON_START:
+            return json_loads(payload) if head else {}
+        if msgpack is None:
+            raise ValueError("msgpack state but msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+# ============ STORAGE BACKENDS ============
+# Every piece of state is a "store": a dict of JSON values keyed by string
+# (users_data, spam_data, pending_verifications, ...). A backend loads a
+# whole store at startup and persists either the whole store or only the
+# keys that were touched.
+
+class Storage:
+    """Base class for state backends"""
+
+    def load(self, name, default=None):
+        """Return the stored dict for `name`, or a copy of `default`"""
+        raise NotImplementedError
+
+    def save(self, name, data, keys=None):
+        """Persist `data`; when `keys` is given only those keys are written.
+        Returns the number of bytes written."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def lock_for(self, name):
+        """Per-store write lock. A save takes its snapshot and commits it
+        under this lock, so an older snapshot can't land after a newer one
+        (autosave and the write scheduler save the same stores)."""
+        with self.locks_lock:
+            return self.locks.setdefault(name, threading.Lock())
+
+
+class JsonStorage(Storage):
+    """One file per store (the original layout).
+
+    Stores listed in `sharded_names` are split into `shards` files under
+    data_dir/<name>/ so a change to one user rewrites only that shard.
+    """
+
+    def __init__(self, data_dir, serializer=None, shards=0, sharded_names=(), max_loaded_shards=None):
+        self.data_dir = data_dir
+        self.serializer = serializer or Serializer()
+        self.shards = shards
+        self.sharded_names = set(sharded_names) if shards > 0 else set()
+        self.max_loaded_shards = max_loaded_shards
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f"{name}.json")
+
+    def shard_path(self, name, index):
+        return os.path.join(self.data_dir, name, f"shard_{index:03d}.json")
+
+    def manifest_path(self, name):
+        return os.path.join(self.data_dir, name, "manifest.json")
+
+    def read(self, filepath):
+        with open(filepath, 'rb') as f:
+            return self.serializer.loads(f.read())
+
+    def load(self, name, default=None):
+        if default is None:
+            default = {}
+        if name in self.sharded_names:
+            return self.load_sharded(name)
+        filepath = self.path(name)
+        if os.path.exists(filepath):
+            return self.read(filepath)
+        if os.path.exists(self.manifest_path(name)):
+            # Sharding was turned off: merge the shards back into one file
+            return self.unshard(name)
+        atomic_write(filepath, self.serializer.dumps(default))
+        return dict(default)
+
+    def read_store(self, name):
+        """A store's entries from its file or its shards; None if neither exists"""
+        if os.path.exists(self.path(name)):
+            return self.read(self.path(name))
+        manifest_path = self.manifest_path(name)
+        if os.path.exists(manifest_path):
+            return self.read_shards(name, self.read(manifest_path))
+        return None
+
+    def save(self, name, data, keys=None):
+        if isinstance(data, ShardedDict):
+            return self.save_sharded(name, data, keys)
+        # A JSON file can't be patched in place: the whole store is written,
+        # `keys` only says which entries must be copied consistently
+        with self.lock_for(name):
+            payload = self.serializer.dumps(store_snapshot(data, keys))
+            atomic_write(self.path(name), payload)
+        return len(payload)
+
+    # ---------- sharded stores ----------
+    def load_sharded(self, name):
+        manifest_path = self.manifest_path(name)
+        manifest = self.read(manifest_path) if os.path.exists(manifest_path) else None
+        if manifest is None or manifest.get("shards") != self.shards:
+            self.reshard(name, manifest)
+            manifest = self.read(manifest_path)
+
+        def load_shard(index):
+            shard_path = self.shard_path(name, index)
+            return self.read(shard_path) if os.path.exists(shard_path) else {}
+
+        return ShardedDict(self.shards, load_shard, manifest.get("counts"), self.max_loaded_shards)
+
+    def read_shards(self, name, manifest):
+        data = {}
+        for index in range(manifest["shards"]):
+            shard_path = self.shard_path(name, index)
+            if os.path.exists(shard_path):
+                data.update(self.read(shard_path))
+        return data
+
+    def remove_shards(self, name, manifest):
+        for index in range(manifest["shards"]):
+            shard_path = self.shard_path(name, index)
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+
+    def unshard(self, name):
+        """Merge a store's shards into the monolithic file and remove them"""
+        manifest = self.read(self.manifest_path(name))
+        data = self.read_shards(name, manifest)
+        atomic_write(self.path(name), self.serializer.dumps(data))
+        os.remove(self.manifest_path(name))
+        self.remove_shards(name, manifest)
+        print(f"✅ Merged {name} shards back into one file ({len(data)} entries)")
+        return data
+
+    def reshard(self, name, manifest):
+        """Split the monolithic file (or shards of a different count) into
+        the configured number of shards"""
+        monolithic = self.path(name)
+        if manifest is not None:
+            data = self.read_shards(name, manifest)
+            self.remove_shards(name, manifest)
+        elif os.path.exists(monolithic):
+            data = self.read(monolithic)
+        else:
+            data = {}
+        os.makedirs(os.path.join(self.data_dir, name), exist_ok=True)
+        buckets = [{} for _ in range(self.shards)]
+        for key, value in data.items():
+            buckets[zlib.crc32(str(key).encode()) % self.shards][key] = value
+        for index, bucket in enumerate(buckets):
+            atomic_write(self.shard_path(name, index), self.serializer.dumps(bucket))
+        self.write_manifest(name, [len(b) for b in buckets])
+        if os.path.exists(monolithic):
+            # Keep it as a backup, under a name nothing loads
+            os.replace(monolithic, monolithic + ".presharded")
+        print(f"✅ Split {name} into {self.shards} shards ({len(data)} entries)")
+
+    def write_manifest(self, name, counts):
+        atomic_write(self.manifest_path(name), self.serializer.dumps({"shards": self.shards, "counts": counts}))
+
+    def save_sharded(self, name, data, keys=None):
+        written = 0
+        with self.lock_for(name):
+            unsaved = data.unsaved_shards()
+            for index, version, shard in unsaved:
+                # Keys from other shards are simply not found in this one
+                payload = self.serializer.dumps(store_snapshot(shard, keys, data.key_lock))
+                atomic_write(self.shard_path(name, index), payload)
+                data.mark_saved(index, version)
+                written += len(payload)
+            if unsaved:
+                self.write_manifest(name, [
+                    len(s) if s is not None else data.counts[i]
+                    for i, s in enumerate(data.shards)
+                ])
+        return written
+
+
+class SqliteStorage(Storage):
+    """All stores in one SQLite database, one row per key (WAL mode)"""
+
+    def __init__(self, db_path, serializer=None):
+        self.db_path = db_path
+        self.serializer = serializer or Serializer()
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "store TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+            "PRIMARY KEY (store, key)) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+
+    def has_store(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM state WHERE store = ? LIMIT 1", (name,)).fetchone()
+        return row is not None
+
+    def load(self, name, default=None):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, value FROM state WHERE store = ?", (name,)).fetchall()
+        if not rows:
+            return dict(default or {})
+        return {key: self.serializer.loads(value) for key, value in rows}
+
+    def save(self, name, data, keys=None):
+        written = 0
+        with self.lock_for(name):
+            entries = snapshot(data, keys)
+            with self.lock:
+                self.conn.execute("BEGIN")
+                try:
+                    if keys is None:
+                        rows = [(name, key, self.encode(value)) for key, value in entries.items()]
+                        self.conn.execute("DELETE FROM state WHERE store = ?", (name,))
+                        self.conn.executemany("INSERT INTO state (store, key, value) VALUES (?, ?, ?)", rows)
+                        written = sum(len(row[2]) for row in rows)
+                    else:
+                        for key in keys:
+                            key = str(key)
+                            value = entries.get(key, _MISSING)
+                            if value is not _MISSING:
+                                encoded = self.encode(value)
+                                self.conn.execute(
+                                    "INSERT OR REPLACE INTO state (store, key, value) VALUES (?, ?, ?)",
+                                    (name, key, encoded)
+                                )
+                                written += len(encoded)
+                            else:
+                                self.conn.execute("DELETE FROM state WHERE store = ? AND key = ?", (name, key))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+        return written
+
+    def encode(self, value):
+        return self.serializer.dumps(value)
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class JournalStorage(Storage):
+    """Snapshot files plus an append-only journal of per-key mutations.
+
+    Each save appends one JSON line per key to journal.log; the OS write
+    happens immediately and fsync is batched by a background thread. On
+    startup the journal is replayed over the snapshots. Once the journal
+    grows past `compact_bytes` it is rotated and folded into fresh snapshots.
+    """
+
+    JOURNAL = "journal.log"
+    ROTATED = "journal.old"
+
+    def __init__(self, data_dir, fsync_interval=1.0, compact_bytes=8 * 1024 * 1024, serializer=None):
+        self.data_dir = data_dir
+        self.serializer = serializer or Serializer()
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.live = {}
+        self.unsynced = False
+        self.compactions = 0
+        self.replay = {}
+        # A rotated journal left behind by an interrupted compaction is
+        # older than the current one, so it is replayed first
+        for filename in (self.ROTATED, self.JOURNAL):
+            self._read_journal(os.path.join(data_dir, filename))
+        self.journal_path = os.path.join(data_dir, self.JOURNAL)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_size = self.journal.tell()
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f"{name}.json")
+
+    def _read_journal(self, filepath):
+        if not os.path.exists(filepath):
+            return
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    # Torn tail from a crash mid-append
+                    logger.warning(f"Skipping corrupt journal record {filepath}:{line_no}")
+                    continue
+                self.replay.setdefault(record["s"], []).append(record)
+
+    def load(self, name, default=None):
+        filepath = self.path(name)
+        if os.path.exists(filepath):
+            with open(filepath, 'rb') as f:
+                data = self.serializer.loads(f.read())
+        else:
+            data = dict(default or {})
+        for record in self.replay.pop(name, []):
+            if "all" in record:
+                data = record["all"]
+            elif record.get("d"):
+                data.pop(record["k"], None)
+            else:
+                data[record["k"]] = record["v"]
+        self.live[name] = data
+        return data
+
+    def save(self, name, data, keys=None):
+        self.live[name] = data
+        with self.lock_for(name):
+            entries = snapshot(data, keys)
+            if keys is None:
+                lines = [self.encode({"s": name, "all": entries})]
+            else:
+                lines = []
+                for key in keys:
+                    key = str(key)
+                    value = entries.get(key, _MISSING)
+                    if value is _MISSING:
+                        lines.append(self.encode({"s": name, "k": key, "d": 1}))
+                    else:
+                        lines.append(self.encode({"s": name, "k": key, "v": value}))
+            chunk = "".join(lines)
+            size = len(chunk.encode('utf-8'))
+            with self.lock:
+                self.journal.write(chunk)
+                self.journal.flush()
+                self.journal_size += size
+                self.unsynced = True
+                should_compact = self.journal_size >= self.compact_bytes
+        if should_compact and not self.compact_lock.locked():
+            threading.Thread(target=self.compact, daemon=True).start()
+        return size
+
+    def encode(self, record):
+        # Journal lines stay JSON so the file can be split on newlines
+        return json_dumps(record).decode() + "\n"
+
+    def sync(self):
+        """fsync barrier: everything saved so far is on disk after this"""
+        with self.lock:
+            if self.unsynced:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.unsynced = False
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Journal fsync error: {e}")
+
+    def compact(self):
+        """Fold the journal into fresh snapshot files"""
+        if not self.compact_lock.acquire(blocking=False):
+            return
+        try:
+            rotated_path = os.path.join(self.data_dir, self.ROTATED)
+            with self.lock:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+                if os.path.exists(rotated_path):
+                    # A previous compaction failed; keep its records
+                    with open(rotated_path, 'a', encoding='utf-8') as rotated, \
+                            open(self.journal_path, 'r', encoding='utf-8') as current:
+                        rotated.write(current.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, rotated_path)
+                self.journal = open(self.journal_path, 'a', encoding='utf-8')
+                self.journal_size = 0
+                self.unsynced = False
+                stores = list(self.live.items())
+            # Changes made from here on are also in the new journal, and
+            # replaying them over a newer snapshot is harmless
+            for name, data in stores:
+                payload = self.serializer.dumps(snapshot(data))
+                atomic_write(self.path(name), payload)
+            os.remove(rotated_path)
+            self.compactions += 1
+            logger.info(f"Journal compacted into {len(stores)} snapshots")
+        except Exception as e:
+            logger.error(f"Journal compaction error: {e}")
+        finally:
+            self.compact_lock.release()
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            self.journal.close()
+
+
+def atomic_write(filepath, payload):
+    """Write bytes to a temp file, fsync it and rename it over `filepath`"""
+    tmp_path = f"{filepath}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+
+# ============ CONSISTENT SNAPSHOTS ============
+class StripedLocks:
+    """A fixed pool of locks shared out by a hash of the key (user id)"""
+
+    def __init__(self, stripes=64):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+
+    def lock_for(self, key):
+        return self.locks[zlib.crc32(str(key).encode()) % len(self.locks)]
+
+
+def plain_copy(value):
+    """Copy of nested dicts/lists/records, detached from the live store"""
+    if isinstance(value, dict):
+        return {k: plain_copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [plain_copy(v) for v in value]
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    return value
+
+
+def copy_entry(key_lock, key, value):
+    """Copy one entry under its key lock. Holders only keep the lock for an
+    in-memory change to that user's entries, so this waits briefly at most."""
+    if key_lock is None:
+        return dump_retrying(lambda: plain_copy(value))
+    with key_lock(key):
+        return plain_copy(value)
+
+
+def snapshot(data, keys=None, key_lock=None):
+    """Plain copy of a store's entries that is safe to serialize while
+    handlers keep writing. With `keys`, only those entries (missing ones
+    are left out), each copied under its key lock. Without, every entry is
+    copied lock-free: an entry caught mid-change is saved again by the
+    save call that follows the change."""
+    if keys is None:
+        return dump_retrying(lambda: {key: plain_copy(value) for key, value in list(data.items())})
+    if key_lock is None:
+        key_lock = getattr(data, "key_lock", None)
+    entries = {}
+    for key in keys:
+        key = str(key)
+        value = data.get(key, _MISSING)
+        if value is not _MISSING:
+            entries[key] = copy_entry(key_lock, key, value)
+    return entries
+
+
+def store_snapshot(data, keys=None, key_lock=None):
+    """Whole-store copy for backends that rewrite the full file: lock-free,
+    except that the entries being saved (`keys`) are copied under their lock"""
+    entries = snapshot(data)
+    if keys:
+        entries.update(snapshot(data, keys, key_lock))
+    return entries
+
+
+def dump_retrying(dump, attempts=3):
+    """Run a serializer, retrying if a handler resized a nested dict mid-dump"""
+    for attempt in range(attempts):
+        try:
+            return dump()
+        except RuntimeError:
+            if attempt == attempts - 1:
+                raise
+
+
+# ============ WRITE SCHEDULER ============
+class WriteScheduler:
+    """Background writer that takes saves off the handler threads.
+
+    Requests for the same store arriving within `window` seconds are merged
+    into one write (key sets are unioned; a full save absorbs everything).
+    flush() blocks until every accepted request has been written.
+    """
+
+    def __init__(self, storage, window=0.5):
+        self.storage = storage
+        self.window = window
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.first_submit = None
+        self.writing = False
+        self.flush_waiters = 0
+        self.submitted = 0
+        self.written = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, name, data, keys=None):
+        with self.cond:
+            self.submitted += 1
+            if name in self.pending:
+                _, queued_keys = self.pending[name]
+                if queued_keys is None or keys is None:
+                    keys = None
+                else:
+                    keys = queued_keys | set(keys)
+            elif keys is not None:
+                keys = set(keys)
+            self.pending[name] = (data, keys)
+            if self.first_submit is None:
+                self.first_submit = time.time()
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Durability barrier: wait until queued writes reach the backend"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            self.flush_waiters += 1
+            self.cond.notify_all()
+            try:
+                while self.pending or self.writing:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                self.flush_waiters -= 1
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Hold the batch open for the coalescing window unless
+                # someone is waiting on flush()
+                while not self.flush_waiters:
+                    delay = self.first_submit + self.window - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                batch, self.pending = self.pending, {}
+                self.first_submit = None
+                self.writing = True
+            for name, (data, keys) in batch.items():
+                try:
+                    self.storage.save(name, data, keys)
+                    self.written += 1
+                except Exception as e:
+                    logger.error(f"Error writing {name}: {e}")
+                    if isinstance(data, DirtyTracker):
+                        data.restore_dirty(keys is None, keys or set())
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+
+# ============ DIRTY TRACKING ============
+class DirtyTracker:
+    """Remembers which keys of a store changed since the last flush"""
+
+    # Set to StripedLocks.lock_for to copy entries under their key's lock
+    key_lock = None
+
+    def init_tracking(self):
+        self.dirty_lock = threading.Lock()
+        self.dirty = set()
+        self.all_dirty = False
+
+    def touch(self, *keys):
+        with self.dirty_lock:
+            self.dirty.update(str(k) for k in keys)
+
+    def take_dirty(self):
+        """Return (all_dirty, keys) and reset the tracking"""
+        with self.dirty_lock:
+            all_dirty, keys = self.all_dirty, self.dirty
+            self.all_dirty, self.dirty = False, set()
+        return all_dirty, keys
+
+    def discard_dirty(self, keys):
+        with self.dirty_lock:
+            self.dirty.difference_update(keys)
+
+    def restore_dirty(self, all_dirty, keys):
+        """Put back marks taken by a flush that failed"""
+        with self.dirty_lock:
+            self.all_dirty = self.all_dirty or all_dirty
+            self.dirty.update(keys)
+
+    def is_dirty(self):
+        return self.all_dirty or bool(self.dirty)
+
+    def mark_all_dirty(self):
+        with self.dirty_lock:
+            self.all_dirty = True
+            self.dirty = set()
+
+
+class TrackedDict(DirtyTracker, dict):
+    """dict that remembers which keys changed since the last flush.
+
+    Assigning or deleting a key marks it automatically. Code that mutates a
+    nested value in place (users_data[uid]['is_premium'] = True) must call
+    touch(uid) or save it explicitly.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_tracking()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.touch(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.touch(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.touch(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.touch(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.mark_all_dirty()
+
+
+class ShardedDict(DirtyTracker, MutableMapping):
+    """Mapping split into `n` shard files by a hash of the key.
+
+    Shards are loaded on first access and, past `max_loaded`, shards with
+    no unsaved changes are dropped from memory again (least recently used
+    first). Each shard carries a version that is bumped on every change;
+    a shard is clean once the version written to disk catches up.
+
+    A clean shard can still hold a record a handler has just read and is
+    about to change and save; dropping it would lose that change. So only
+    shards nobody has accessed for `evict_after` seconds are dropped, and
+    until then more than `max_loaded` shards may stay in memory.
+    """
+
+    def __init__(self, n, load_shard, counts=None, max_loaded=None, evict_after=60):
+        self.init_tracking()
+        self.n = n
+        self.load_shard = load_shard
+        self.decode = None
+        self.max_loaded = max_loaded or n
+        self.shards = [None] * n
+        self.counts = list(counts or [0] * n)
+        self.versions = [0] * n
+        self.saved_versions = [0] * n
+        self.last_used = [0.0] * n
+        self.evict_after = evict_after
+        self.shard_lock = threading.Lock()
+
+    def shard_of(self, key):
+        return zlib.crc32(str(key).encode()) % self.n
+
+    def shard(self, index):
+        shard = self.shards[index]
+        if shard is None:
+            with self.shard_lock:
+                shard = self.shards[index]
+                if shard is None:
+                    shard = self.load_shard(index)
+                    if self.decode is not None:
+                        shard = {k: self.decode(v) for k, v in shard.items()}
+                    self.shards[index] = shard
+                    self._evict(keep=index)
+        self.last_used[index] = time.time()
+        return shard
+
+    def _evict(self, keep):
+        loaded = [i for i, s in enumerate(self.shards) if s is not None]
+        if len(loaded) <= self.max_loaded:
+            return
+        idle_since = time.time() - self.evict_after
+        clean = sorted(
+            (i for i in loaded if i != keep and self.versions[i] == self.saved_versions[i]
+             and self.last_used[i] <= idle_since),
+            key=lambda i: self.last_used[i]
+        )
+        for index in clean[:len(loaded) - self.max_loaded]:
+            self.counts[index] = len(self.shards[index])
+            self.shards[index] = None
+
+    def bump(self, key):
+        index = self.shard_of(key)
+        self.versions[index] += 1
+
+    def touch(self, *keys):
+        for key in keys:
+            self.bump(key)
+        super().touch(*keys)
+
+    def loaded_shards(self):
+        return [(i, s) for i, s in enumerate(self.shards) if s is not None]
+
+    def loaded_keys(self):
+        """Keys of the shards in memory, without loading any others"""
+        return [key for _, shard in self.loaded_shards() for key in list(shard)]
+
+    def unsaved_shards(self):
+        """(index, version, shard) for every shard with changes not on disk"""
+        return [
+            (i, self.versions[i], s) for i, s in self.loaded_shards()
+            if self.versions[i] != self.saved_versions[i]
+        ]
+
+    def mark_saved(self, index, version):
+        self.saved_versions[index] = max(self.saved_versions[index], version)
+        self.counts[index] = len(self.shards[index] or {})
+
+    def __getitem__(self, key):
+        return self.shard(self.shard_of(key))[key]
+
+    def __setitem__(self, key, value):
+        self.shard(self.shard_of(key))[key] = value
+        self.touch(key)
+
+    def __delitem__(self, key):
+        del self.shard(self.shard_of(key))[key]
+        self.touch(key)
+
+    def __contains__(self, key):
+        return key in self.shard(self.shard_of(key))
+
+    def __iter__(self):
+        for index in range(self.n):
+            # Iterate a copy so other threads can keep writing
+            yield from list(self.shard(index))
+
+    def __len__(self):
+        return sum(
+            len(s) if s is not None else self.counts[i]
+            for i, s in enumerate(self.shards)
+        )
+
+    def items(self):
+        for index in range(self.n):
+            yield from list(self.shard(index).items())
+
+    def values(self):
+        for index in range(self.n):
+            yield from list(self.shard(index).values())
+
+    def scan_items(self):
+        """items() without keeping unloaded shards in memory: those are
+        read from disk, which is current since only clean shards unload"""
+        for index in range(self.n):
+            shard = self.shards[index]
+            if shard is None:
+                shard = self.load_shard(index)
+                if self.decode is not None:
+                    shard = {k: self.decode(v) for k, v in shard.items()}
+            yield from list(shard.items())
+
+    def clear(self):
+        with self.shard_lock:
+            for index in range(self.n):
+                self.shards[index] = {}
+                self.versions[index] += 1
+        self.mark_all_dirty()
+
+
+# ============ MIGRATION ============
+def migrate_json_to_sqlite(data_dir, sqlite_storage, names):
+    """One-shot import of the legacy /data/*.json files into SQLite"""
+    if sqlite_storage.get_meta("migrated_from_json"):
+        return 0
+    migrated = 0
+    failed = 0
+    json_storage = JsonStorage(data_dir, sqlite_storage.serializer)
+    for name in names:
+        if sqlite_storage.has_store(name):
+            continue
+        try:
+            # The monolithic file, or the shards if the store was sharded
+            data = json_storage.read_store(name)
+            if data is None:
+                continue
+            sqlite_storage.save(name, data)
+            migrated += 1
+            print(f"✅ Migrated {name}: {len(data)} entries")
+        except Exception as e:
+            logger.error(f"Error migrating {name}: {e}")
+            failed += 1
+    # Retry on next boot if anything failed
+    if not failed:
+        sqlite_storage.set_meta("migrated_from_json", 1)
+    return migrated
+
+
+def open_storage(backend, data_dir, **options):
+    """Create the configured backend"""
+    serializer = Serializer(options.get("state_format", "compact"))
+    if backend == "json" and options.get("shards", 0) > 0:
+        return JsonStorage(
+            data_dir,
+            serializer,
+            shards=options["shards"],
+            sharded_names=options.get("sharded_names", ()),
+            max_loaded_shards=options.get("max_loaded_shards")
+        )
+    if backend == "sqlite":
+        return SqliteStorage(os.path.join(data_dir, "bot.db"), serializer)
+    if backend == "journal":
+        return JournalStorage(
+            data_dir,
+            fsync_interval=options.get("fsync_interval", 1.0),
+            compact_bytes=options.get("compact_bytes", 8 * 1024 * 1024),
+            serializer=serializer
+        )
+    return JsonStorage(data_dir, serializer)
@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+from contextlib import nullcontext
+
+from records import parse_time
+from storage import json_dumps, ShardedDict
+
+logger = logging.getLogger(__name__)
+
+# ============ STATE SWEEPER ============
+# Periodic compaction of the stores that otherwise only grow:
+# - spam_data entries whose ban expired more than `spam_retention` seconds
+#   ago and whose user has no recent requests in the limiter
+# - invite links that are used or expired; they are appended to a cold
+#   archive file (one JSON line per link) and removed from invite_links
+# - finished or cancelled broadcast jobs not updated for `job_retention`
+#   seconds (each one holds its content and checkpoint)
+#
+# Each user's entry is re-checked and changed under that user's lock
+# (`lock_for`, config.user_locks), like the handlers' own changes, so a
+# sweep can't drop or half-archive a link a handler is adding.
+#
+# A sharded store is only swept in the shards already in memory: listing
+# every key would load them all and defeat idle shard eviction. The other
+# shards get their turn in a later sweep that finds them loaded.
+
+
+def no_lock(uid):
+    return nullcontext()
+
+
+def sweep_keys(store):
+    if isinstance(store, ShardedDict):
+        return store.loaded_keys()
+    return list(store.keys())
+
+
+def sweep_spam_data(spam_data, ban_registry, spam_limiter, spam_retention, now, lock_for=no_lock):
+    """Drop stale spam entries; returns (keys, bytes)"""
+    cutoff = now - spam_retention
+    stale = []
+    reclaimed = 0
+    for uid in sweep_keys(spam_data):
+        with lock_for(uid):
+            entry = spam_data.get(uid)
+            if entry is None or ban_registry.is_blocked(uid, now) or uid in spam_limiter:
+                continue
+            if entry.get("blocked_until", 0) < cutoff:
+                stale.append(uid)
+                reclaimed += len(json_dumps(entry))
+                spam_data.pop(uid, None)
+    return stale, reclaimed
+
+
+def sweep_invite_links(invite_links, archive_path, now, lock_for=no_lock):
+    """Move used/expired links to the archive; returns (changed keys, links, bytes)"""
+    changed = []
+    archived = []
+    reclaimed = 0
+    for uid in sweep_keys(invite_links):
+        with lock_for(uid):
+            links = invite_links.get(uid)
+            if not links:
+                continue
+            keep = []
+            for link in links:
+                expires_at = parse_time(link.get("expires_at"))
+                if link.get("used") or (expires_at and expires_at < now):
+                    record = dict(link, user_id=uid)
+                    archived.append(json_dumps(record))
+                    reclaimed += len(json_dumps(link))
+                else:
+                    keep.append(link)
+            if len(keep) != len(links):
+                changed.append(uid)
+                if keep:
+                    invite_links[uid] = keep
+                else:
+                    del invite_links[uid]
+    if archived:
+        # Archive first: a crash before the store is saved only duplicates lines
+        with open(archive_path, 'ab') as f:
+            f.write(b"\n".join(archived) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+    return changed, len(archived), reclaimed
+
+
+TERMINAL_JOB_STATES = ("done", "cancelled")
+
+
+def sweep_broadcast_jobs(broadcast_jobs, job_retention, now, lock=None):
+    """Drop old finished/cancelled jobs; returns (keys, bytes)"""
+    cutoff = now - job_retention
+    dropped = []
+    reclaimed = 0
+    with lock or nullcontext():
+        for job_id, job in list(broadcast_jobs.items()):
+            if job.get("status") in TERMINAL_JOB_STATES and job.get("updated", 0) < cutoff:
+                dropped.append(job_id)
+                reclaimed += len(json_dumps(job))
+                del broadcast_jobs[job_id]
+    return dropped, reclaimed
+
+
+def run_sweep(spam_data, invite_links, ban_registry, spam_limiter, archive_path, spam_retention,
+              lock_for=no_lock):
+    """Run one sweep and return a report dict"""
+    start = time.time()
+    now = start
+    spam_keys, spam_bytes = sweep_spam_data(spam_data, ban_registry, spam_limiter, spam_retention, now, lock_for)
+    link_keys, links_archived, link_bytes = sweep_invite_links(invite_links, archive_path, now, lock_for)
+    report = {
+        "spam_entries": len(spam_keys),
+        "spam_keys": spam_keys,
+        "links_archived": links_archived,
+        "link_keys": link_keys,
+        "rate_windows": spam_limiter.sweep(now),
+        "bytes": spam_bytes + link_bytes,
+        "duration_ms": (time.time() - start) * 1000
+    }
+    logger.info(
+        f"Sweep: {report['spam_entries']} spam entries, {links_archived} invite links, "
+        f"{report['bytes']} bytes reclaimed in {report['duration_ms']:.1f} ms"
+    )
+    return report
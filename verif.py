@@ -15,14 +15,14 @@ class VerificationSystem:
         self.bot = bot
         self.pending = pending_verifications
     
-    def save_pending(self):
-        """Save pending verifications"""
-        save_json_file(PENDING_VERIF_FILE, self.pending)
+    def save_pending(self, user_id=None):
+        """Save pending verifications (only one user's entry if given)"""
+        save_json_file(PENDING_VERIF_FILE, self.pending, [str(user_id)] if user_id is not None else None)
     
     def create_invite_link(self, user_id, plan_type):
         """Create unique invite link for specific channel based on plan"""
         try:
-            plan = PLANS[plan_type]
+            plan = current_settings().plans[plan_type]
             channel_id = plan.get('channel_id', '')
             
             if not channel_id:
@@ -47,22 +47,23 @@ class VerificationSystem:
             # Get current invite_links from global scope
             global invite_links
             
-            # Check if user_id exists in invite_links
-            if user_id_str not in invite_links:
-                # If not, create a new list
-                invite_links[user_id_str] = []
-            
-            # Now append to the list (not to the dictionary)
-            invite_links[user_id_str].append({
-                "link": invite.invite_link,
-                "plan": plan_type,
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "expires_at": expire_date.strftime("%Y-%m-%d %H:%M:%S"),
-                "used": False
-            })
+            with user_locks.lock_for(user_id_str):
+                # Check if user_id exists in invite_links
+                if user_id_str not in invite_links:
+                    # If not, create a new list
+                    invite_links[user_id_str] = []
+                
+                # Now append to the list (not to the dictionary)
+                invite_links[user_id_str].append({
+                    "link": invite.invite_link,
+                    "plan": plan_type,
+                    "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "expires_at": expire_date.strftime("%Y-%m-%d %H:%M:%S"),
+                    "used": False
+                })
             
             # Save to file
-            save_json_file(INVITE_LINKS_FILE, invite_links)
+            save_invite_links(user_id_str)
             
             return invite.invite_link
             
@@ -75,54 +76,17 @@ class VerificationSystem:
     
     def plan_selection_keyboard(self):
         """Show plan selection buttons"""
-        keyboard = types.InlineKeyboardMarkup(row_width=2)
-        btn1 = types.InlineKeyboardButton(
-            f"📅 {PLANS['monthly']['name']} - ₹{PLANS['monthly']['amount']}", 
-            callback_data="plan_monthly"
-        )
-        btn2 = types.InlineKeyboardButton(
-            f"♾️ {PLANS['lifetime']['name']} - ₹{PLANS['lifetime']['amount']}", 
-            callback_data="plan_lifetime"
-        )
-        btn3 = types.InlineKeyboardButton("❓ How To Get", callback_data="how_to_get")
-        btn4 = types.InlineKeyboardButton("📞 Support", url=f"https://t.me/{settings['support_username']}")
-        keyboard.add(btn1, btn2)
-        keyboard.add(btn3, btn4)
-        return keyboard
+        return current_settings().keyboards["plan_selection"]
     
     def main_menu_keyboard(self):
         """Main menu with demo button"""
-        keyboard = types.InlineKeyboardMarkup(row_width=1)
-        btn1 = types.InlineKeyboardButton("📢 Premium Demo", url=settings['demo_channel_link'])
-        btn2 = types.InlineKeyboardButton("💰 Get Premium", callback_data="get_premium")
-        btn3 = types.InlineKeyboardButton("❓ How To Get", callback_data="how_to_get")
-        keyboard.add(btn1, btn2, btn3)
-        return keyboard
+        return current_settings().keyboards["main_menu"]
     
     def ask_for_screenshot(self, chat_id, user_id, plan_type):
         """Ask user to send payment screenshot"""
-        plan = PLANS[plan_type]
         msg = self.bot.send_message(
             chat_id,
-            f"""
-<b>📸 SEND PAYMENT SCREENSHOT</b>
-
-<b>Plan Selected:</b> {plan['name']}
-<b>Amount to Pay:</b> ₹{plan['amount']}
-<b>UPI ID:</b> <code>{settings['upi_id']}</code>
-
-✅ <b>Payment Done!</b>
-
-Now please send the <b>payment screenshot</b> for verification.
-
-<b>Instructions:</b>
-1. Take screenshot of UPI payment
-2. Send it here as photo
-3. Admin will verify within few minutes
-4. You'll receive unique join link after verification
-
-⏳ <i>Please wait for admin verification...</i>
-            """,
+            current_settings().texts[f"screenshot_request:{plan_type}"],
             parse_mode="HTML"
         )
         return msg
@@ -144,17 +108,19 @@ Now please send the <b>payment screenshot</b> for verification.
         
         pending_data = self.pending[user_id]
         plan_type = pending_data['plan']
-        plan = PLANS[plan_type]
+        snapshot = current_settings()
+        plan = snapshot.plans[plan_type]
         
         # Get the largest photo
         photo = message.photo[-1]
         file_id = photo.file_id
         
         # Store screenshot info
-        pending_data['screenshot_file_id'] = file_id
-        pending_data['screenshot_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        pending_data['screenshot_msg_id'] = message.message_id
-        self.save_pending()
+        with user_locks.lock_for(user_id):
+            pending_data['screenshot_file_id'] = file_id
+            pending_data['screenshot_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            pending_data['screenshot_msg_id'] = message.message_id
+        self.save_pending(user_id)
         
         # Create verification buttons for admin
         keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -184,7 +150,7 @@ Now please send the <b>payment screenshot</b> for verification.
         try:
             # Send screenshot to log channel
             sent_msg = self.bot.send_photo(
-                settings['log_channel'],
+                snapshot['log_channel'],
                 photo=file_id,
                 caption=caption,
                 reply_markup=keyboard,
@@ -192,9 +158,10 @@ Now please send the <b>payment screenshot</b> for verification.
             )
             
             # Store admin message ID
-            pending_data['admin_msg_id'] = sent_msg.message_id
-            pending_data['admin_chat_id'] = settings['log_channel']
-            self.save_pending()
+            with user_locks.lock_for(user_id):
+                pending_data['admin_msg_id'] = sent_msg.message_id
+                pending_data['admin_chat_id'] = snapshot['log_channel']
+            self.save_pending(user_id)
             
             # Notify user
             self.bot.reply_to(
@@ -214,7 +181,7 @@ You'll receive unique join link within few minutes.
             logger.error(f"Error forwarding screenshot: {e}")
             self.bot.reply_to(
                 message,
-                f"❌ Error sending screenshot. Please contact @{settings['support_username']}"
+                f"❌ Error sending screenshot. Please contact @{snapshot['support_username']}"
             )
         
         return True
@@ -228,7 +195,8 @@ You'll receive unique join link within few minutes.
         
         pending_data = self.pending[user_id]
         plan_type = pending_data['plan']
-        plan = PLANS[plan_type]
+        snapshot = current_settings()
+        plan = snapshot.plans[plan_type]
         
         # Create unique invite link for specific channel
         invite_link = self.create_invite_link(user_id, plan_type)
@@ -273,25 +241,29 @@ You'll receive unique join link within few minutes.
             """
             
             self.bot.send_message(
-                settings['log_channel'],
+                snapshot['log_channel'],
                 log_msg,
                 parse_mode="HTML"
             )
             
             # Update user data to mark as premium
-            if user_id in users_data:
-                users_data[user_id]['is_premium'] = True
-                users_data[user_id]['premium_plan'] = plan_type
-                users_data[user_id]['premium_until'] = (
-                    "lifetime" if plan_type == "lifetime" 
-                    else (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
-                )
-                users_data[user_id]['invite_link'] = invite_link
-                save_users_data()
-            
-            # Remove from pending
-            del self.pending[user_id]
-            self.save_pending()
+            with user_locks.lock_for(user_id):
+                is_known = user_id in users_data
+                if is_known:
+                    users_data[user_id]['is_premium'] = True
+                    users_data[user_id]['premium_plan'] = plan_type
+                    users_data[user_id]['premium_until'] = (
+                        "lifetime" if plan_type == "lifetime" 
+                        else (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
+                    )
+                    users_data[user_id]['invite_link'] = invite_link
+                # Remove from pending
+                self.pending.pop(user_id, None)
+            if is_known:
+                save_users_data(user_id)
+            self.save_pending(user_id)
+            # Premium status must be on disk before the admin sees success
+            flush_writes()
             
             return True, "User verified and unique join link sent"
             
@@ -307,6 +279,7 @@ You'll receive unique join link within few minutes.
             return False, "User not found in pending verifications"
         
         pending_data = self.pending[user_id]
+        snapshot = current_settings()
         
         # Notify user
         try:
@@ -321,7 +294,7 @@ Your payment screenshot could not be verified.
 • Payment not received
 
 <b>Please try again or contact support:</b>
-📞 @{settings['support_username']}
+📞 @{snapshot['support_username']}
             """
             
             self.bot.send_message(
@@ -340,14 +313,15 @@ Your payment screenshot could not be verified.
             """
             
             self.bot.send_message(
-                settings['log_channel'],
+                snapshot['log_channel'],
                 log_msg,
                 parse_mode="HTML"
             )
             
             # Remove from pending
-            del self.pending[user_id]
-            self.save_pending()
+            with user_locks.lock_for(user_id):
+                self.pending.pop(user_id, None)
+            self.save_pending(user_id)
             
             return True, "Payment rejected and user notified"
             
@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+import logging
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+# ============ WEBHOOK INGESTION ============
+# In webhook mode Telegram POSTs each update to the web app. The request
+# handler only checks the secret token and puts the raw body on a bounded
+# queue, then answers at once. A few ingest workers parse the bodies and
+# hand them to bot.process_new_updates (the lane dispatcher), so handlers
+# never run inside a web request. When the queue is full the request gets
+# a 503 and Telegram delivers the update again later.
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookIngest:
+    """Bounded queue of raw webhook bodies and the workers draining it"""
+
+    def __init__(self, bot, queue_size=1000, workers=2):
+        self.bot = bot
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.registered = threading.Event()
+        self.lock = threading.Lock()
+        self.metrics = {"received": 0, "rejected": 0, "processed": 0, "errors": 0}
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.worker, name=f"webhook-{i}", daemon=True).start()
+
+    def put(self, body):
+        """Queue one raw update body; False if the queue is full"""
+        try:
+            self.queue.put_nowait(body)
+            outcome = "received"
+        except queue.Full:
+            outcome = "rejected"
+        with self.lock:
+            self.metrics[outcome] += 1
+        return outcome == "received"
+
+    def worker(self):
+        while True:
+            body = self.queue.get()
+            try:
+                update = types.Update.de_json(body.decode("utf-8"))
+                self.bot.process_new_updates([update])
+                outcome = "processed"
+            except Exception as e:
+                outcome = "errors"
+                logger.error(f"Webhook update error: {e}")
+            with self.lock:
+                self.metrics[outcome] += 1
+
+    def register(self, url, secret, max_connections=40, attempts=5):
+        """Point Telegram at `url`, retrying with backoff; True once set"""
+        delay = 1
+        for attempt in range(1, attempts + 1):
+            try:
+                self.bot.set_webhook(url=url, secret_token=secret, max_connections=max_connections)
+                self.registered.set()
+                logger.info(f"Webhook registered: {url}")
+                return True
+            except Exception as e:
+                logger.error(f"Webhook registration failed ({attempt}/{attempts}): {e}")
+                if attempt < attempts:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 30)
+        return False
+
+    def stats(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        return dict(metrics, depth=self.queue.qsize(), registered=self.registered.is_set())